@@ -0,0 +1,497 @@
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import contextlib
+import argparse
+import subprocess
+import functools
+import threading
+import concurrent.futures
+
+# ffmpeg executable
+FFMPEG_PATH = "ffmpeg"
+
+# Encoding presets, "-like" is the source resolution they are meant for
+PRESETS = {
+    "720p-like": {
+        "codec": "hevc_nvenc",
+        "bitrate": "4M",
+        "maxrate": "4M",
+        "bufsize": "8M",
+    },
+    "1080p-like": {
+        "codec": "hevc_nvenc",
+        "bitrate": "6M",
+        "maxrate": "6M",
+        "bufsize": "12M",
+    },
+}
+# Pick a rung of LADDER per file from its resolution and frame rate
+AUTO_PRESET = "auto"
+DEFAULT_PRESET = AUTO_PRESET
+# Preset used for files that can not be probed in auto mode
+AUTO_FALLBACK_PRESET = "720p-like"
+
+# (max short side, bitrate, maxrate, bufsize), the first rung that fits
+# the source is used, bigger sources get the last one
+LADDER = [
+    (480, "2M", "2M", "4M"),
+    (720, "4M", "4M", "8M"),
+    (1080, "6M", "6M", "12M"),
+    (1440, "10M", "10M", "20M"),
+    (2160, "16M", "16M", "32M"),
+]
+LADDER_CODEC = "hevc_nvenc"
+# Sources above HIGH_FPS get HIGH_FPS_FACTOR times the rung's bitrates
+HIGH_FPS = 31
+HIGH_FPS_FACTOR = 1.5
+PROBE_JOBS = 16
+
+# CPU encoder used when the GPU one is not available or fails
+FALLBACK_CODECS = {
+    "hevc_nvenc": "libx265",
+    "h264_nvenc": "libx264",
+}
+# Consumer NVIDIA cards limit concurrent NVENC sessions
+GPU_JOBS = 3
+# libx265/libx264 use several threads per encode already
+CPU_JOBS = max(1, (os.cpu_count() or 1) // 4)
+
+# ==============================================================================
+# Profiler class
+# v1.1.0
+# ==============================================================================
+
+class Profiler:
+    """Records timing spans of phases and subprocesses and saves them as
+    Chrome trace-event JSON, viewable in chrome://tracing or
+    https://ui.perfetto.dev. Does nothing until enable() is called"""
+    path = None
+    events = []
+    tracks = {}
+    origin = time.perf_counter()
+
+    @staticmethod
+    def enable(path):
+        """Start recording and save to path on exit
+
+        Args:
+            path (str): Trace file path
+        """
+        Profiler.path = path
+        atexit.register(Profiler.save)
+
+    @staticmethod
+    def get_track():
+        """Get the trace row of the caller: its asyncio task, so concurrent
+        tasks do not overlap on one row, otherwise its thread"""
+        asyncio = sys.modules.get("asyncio")
+        task = None
+        if asyncio:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                pass
+        if task:
+            track, name = id(task), task.get_name()
+        else:
+            thread = threading.current_thread()
+            track, name = thread.ident, thread.name
+        Profiler.tracks[track] = name
+        return track
+
+    @staticmethod
+    def add(name, category, start, end, track, args=None):
+        """Add a complete event, start and end from time.perf_counter()"""
+        Profiler.events.append({
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - Profiler.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": track, "args": args or {},
+        })
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category="phase", **args):
+        """Context manager recording a span around its body
+
+        Args:
+            name (str): Span name
+            category (str): Span category
+            **args: Extra values shown with the span
+        """
+        if Profiler.path is None:
+            yield
+            return
+        track = Profiler.get_track()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Profiler.add(name, category, start, time.perf_counter(), track,
+                         args)
+
+    @staticmethod
+    def wrap(func):
+        """Decorator recording a span named after func for every call"""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def command(command):
+        """Context manager recording a span around running command, named
+        after its executable
+
+        Args:
+            command (list): Command line of the process
+        """
+        return Profiler.span(os.path.basename(str(command[0])), "subprocess",
+                             command=" ".join(map(str, command)))
+
+    @staticmethod
+    def save():
+        """Write the recorded spans to the trace file"""
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                     "tid": track, "args": {"name": name}}
+                    for track, name in Profiler.tracks.items()]
+        directory = os.path.dirname(os.path.abspath(Profiler.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(Profiler.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + Profiler.events,
+                       "displayTimeUnit": "ms"}, f)
+
+# ==============================================================================
+# End of Profiler class
+# ==============================================================================
+
+
+print_lock = threading.Lock()
+
+
+def log(message):
+    """Print from worker threads without interleaving lines"""
+    with print_lock:
+        print(message, flush=True)
+
+
+def get_ffprobe_path(ffmpeg_path):
+    """Get ffprobe path next to the ffmpeg executable"""
+    directory, name = os.path.split(ffmpeg_path)
+    return os.path.join(directory, name.replace("ffmpeg", "ffprobe"))
+
+
+def parse_bitrate(bitrate):
+    """Parse bitrate like '4M' or '800k' to bits per second"""
+    bitrate = bitrate.strip().upper()
+    if bitrate.endswith("M"):
+        return int(float(bitrate[:-1]) * 1000000)
+    if bitrate.endswith("K"):
+        return int(float(bitrate[:-1]) * 1000)
+    return int(float(bitrate))
+
+
+def format_bitrate(bits):
+    """Format bits per second for ffmpeg, in kbit/s"""
+    return f"{max(1, round(bits / 1000))}k"
+
+
+def parse_frame_rate(rate):
+    """Parse ffprobe frame rate like '30000/1001', 0 if unknown"""
+    try:
+        num, _, den = (rate or "").partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0
+
+
+def probe_video(ffprobe_path, avi_file):
+    """Get width, height, fps and video bitrate (bits per second) with one
+    ffprobe call. Bitrate falls back to the container bitrate, then to
+    size / duration"""
+    cmd = [
+        ffprobe_path,
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-print_format", "json",
+        "-show_entries",
+        "stream=width,height,r_frame_rate,avg_frame_rate,bit_rate"
+        ":format=bit_rate,size,duration",
+        avi_file,
+    ]
+    with Profiler.command(cmd):
+        result = subprocess.run(cmd, capture_output=True, text=True,
+                                check=True)
+    info = json.loads(result.stdout)
+    stream = info["streams"][0]
+    fmt = info.get("format", {})
+    bitrate = 0
+    if str(stream.get("bit_rate", "")).isdigit():
+        bitrate = int(stream["bit_rate"])
+    elif str(fmt.get("bit_rate", "")).isdigit():
+        bitrate = int(fmt["bit_rate"])
+    elif float(fmt.get("duration") or 0) > 0:
+        bitrate = int(int(fmt.get("size") or 0) * 8 / float(fmt["duration"]))
+    return {
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "fps": parse_frame_rate(stream.get("r_frame_rate"))
+            or parse_frame_rate(stream.get("avg_frame_rate")),
+        "bitrate": bitrate,
+    }
+
+
+def select_preset(video):
+    """Pick the ladder rung for a probed video. Rates are scaled down so
+    the bitrate never exceeds the source's"""
+    short_side = min(video["width"], video["height"])
+    rung = next((rung for rung in LADDER if short_side <= rung[0]), LADDER[-1])
+    factor = HIGH_FPS_FACTOR if video["fps"] > HIGH_FPS else 1
+    bitrate, maxrate, bufsize = (parse_bitrate(rate) * factor
+                                 for rate in rung[1:])
+    if 0 < video["bitrate"] < bitrate:
+        scale = video["bitrate"] / bitrate
+        bitrate, maxrate, bufsize = (rate * scale
+                                     for rate in (bitrate, maxrate, bufsize))
+    return {
+        "codec": LADDER_CODEC,
+        "bitrate": format_bitrate(bitrate),
+        "maxrate": format_bitrate(maxrate),
+        "bufsize": format_bitrate(bufsize),
+    }
+
+
+@Profiler.wrap
+def select_presets(ffmpeg_path, avi_files, jobs=PROBE_JOBS):
+    """Probe files in parallel and pick a preset for each"""
+    ffprobe_path = get_ffprobe_path(ffmpeg_path)
+    presets = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(probe_video, ffprobe_path, avi_file): avi_file
+                   for avi_file in avi_files}
+        for future in concurrent.futures.as_completed(futures):
+            avi_file = futures[future]
+            try:
+                video = future.result()
+            except (subprocess.SubprocessError, OSError, ValueError,
+                    KeyError, IndexError) as e:
+                log(f"Could not probe {avi_file} ({e}), "
+                      f"using {AUTO_FALLBACK_PRESET}")
+                presets[avi_file] = PRESETS[AUTO_FALLBACK_PRESET]
+                continue
+            preset = select_preset(video)
+            log(f"{avi_file}: {video['width']}x{video['height']} "
+                  f"{video['fps']:.3g}fps {format_bitrate(video['bitrate'])} -> "
+                  f"{preset['bitrate']}/{preset['maxrate']}/{preset['bufsize']}")
+            presets[avi_file] = preset
+    return presets
+
+
+def is_gpu_codec(codec):
+    return codec in FALLBACK_CODECS
+
+
+@functools.lru_cache(maxsize=None)
+def is_codec_available(ffmpeg_path, codec):
+    """Check if codec can encode here by encoding a few frames of a test
+    source, which also fails if the CUDA driver or GPU is missing"""
+    cmd = [
+        ffmpeg_path,
+        "-v", "error", "-nostdin",
+        "-f", "lavfi", "-i", "testsrc2=size=256x256:duration=0.2",
+        "-c:v", codec,
+        "-f", "null", "-",
+    ]
+    try:
+        with Profiler.command(cmd):
+            result = subprocess.run(cmd, capture_output=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+@Profiler.wrap
+def resolve_codec(ffmpeg_path, codec):
+    """Get codec to use, the CPU fallback if a GPU codec is unavailable"""
+    if is_gpu_codec(codec) and not is_codec_available(ffmpeg_path, codec):
+        fallback = FALLBACK_CODECS[codec]
+        log(f"{codec} is not available, falling back to {fallback}")
+        return fallback
+    return codec
+
+
+def find_avi_files(input_dir):
+    """Find .avi files in input_dir"""
+    return sorted(os.path.join(input_dir, file) for file in os.listdir(input_dir)
+                  if file.lower().endswith(".avi"))
+
+
+def get_output_file(avi_file):
+    """Get the .mp4 path next to the .avi file"""
+    return os.path.splitext(avi_file)[0] + ".mp4"
+
+
+def get_partial_file(mp4_file):
+    """Get the temporary path the encode is written to before the rename"""
+    directory, name = os.path.split(mp4_file)
+    base, ext = os.path.splitext(name)
+    return os.path.join(directory, f".{base}.part{ext}")
+
+
+def build_ffmpeg_command(ffmpeg_path, avi_file, output_file, preset, codec):
+    """Build ffmpeg command for one file"""
+    cmd = [ffmpeg_path, "-v", "error", "-nostdin", "-y"]
+    if is_gpu_codec(codec):
+        cmd += ["-hwaccel", "cuda"]
+    cmd += [
+        "-i", avi_file,
+        "-c:v", codec,
+        "-b:v", preset["bitrate"],
+        "-maxrate", preset["maxrate"],
+        "-bufsize", preset["bufsize"],
+        "-c:a", "aac",
+        "-map_metadata", "0",
+        output_file,
+    ]
+    return cmd
+
+
+# Function to convert AVI to MP4
+@Profiler.wrap
+def convert_avi_to_mp4(avi_file, preset, codec, ffmpeg_path=FFMPEG_PATH,
+                       rewrite=False):
+    """Convert one file. The encode goes to a hidden .part file that is
+    renamed when done, so an existing .mp4 always means finished. Returns
+    "skipped", "converted" or "failed"
+    """
+    mp4_file = get_output_file(avi_file)
+    if os.path.exists(mp4_file) and not rewrite:
+        log(f"Skipping {avi_file}, {mp4_file} exists")
+        return "skipped"
+    partial_file = get_partial_file(mp4_file)
+
+    # Get the last modified time of the original file
+    last_modified_time = os.path.getmtime(avi_file)
+
+    codecs = [codec]
+    if is_gpu_codec(codec):
+        # e.g. out of NVENC sessions or an unsupported input format
+        codecs.append(FALLBACK_CODECS[codec])
+    try:
+        for i, current in enumerate(codecs):
+            cmd = build_ffmpeg_command(ffmpeg_path, avi_file, partial_file,
+                                       preset, current)
+            with Profiler.command(cmd):
+                result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode == 0:
+                os.replace(partial_file, mp4_file)
+                # Set the last modified time of the new file to match the original file
+                os.utime(mp4_file, (last_modified_time, last_modified_time))
+                log(f"Converted {avi_file} -> {mp4_file} ({current})")
+                return "converted"
+            error = result.stderr.strip().splitlines()[-1:] or ["unknown error"]
+            if i + 1 < len(codecs):
+                log(f"{current} failed for {avi_file}: {error[0]}, "
+                      f"retrying with {codecs[i + 1]}")
+            else:
+                log(f"Failed to convert {avi_file}: {error[0]}")
+        return "failed"
+    finally:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+
+
+@Profiler.wrap
+def convert_all(input_dir=".", preset_name=DEFAULT_PRESET, jobs=None,
+                ffmpeg_path=FFMPEG_PATH, rewrite=False):
+    """Convert every .avi file in input_dir with a worker pool. Returns
+    True if nothing failed"""
+    avi_files = find_avi_files(input_dir)
+    if not avi_files:
+        log(f"No .avi files in {input_dir}")
+        return True
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    pending = []
+    for avi_file in avi_files:
+        if os.path.exists(get_output_file(avi_file)) and not rewrite:
+            log(f"Skipping {avi_file}, {get_output_file(avi_file)} exists")
+            counts["skipped"] += 1
+        else:
+            pending.append(avi_file)
+
+    if preset_name == AUTO_PRESET:
+        presets = select_presets(ffmpeg_path, pending)
+    else:
+        presets = {avi_file: PRESETS[preset_name] for avi_file in pending}
+    codecs = {preset["codec"]: resolve_codec(ffmpeg_path, preset["codec"])
+              for preset in presets.values()}
+    jobs = jobs or (GPU_JOBS if any(map(is_gpu_codec, codecs.values()))
+                    else CPU_JOBS)
+    log(f"Converting {len(pending)} file(s) with {preset_name} "
+          f"({', '.join(sorted(set(codecs.values()))) or '-'}, {jobs} job(s))")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(convert_avi_to_mp4, avi_file,
+                                   presets[avi_file],
+                                   codecs[presets[avi_file]["codec"]],
+                                   ffmpeg_path, rewrite): avi_file
+                   for avi_file in pending}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                counts[future.result()] += 1
+            except OSError as e:
+                log(f"Failed to convert {futures[future]}: {e}")
+                counts["failed"] += 1
+    log(f"Conversion complete! {counts['converted']} converted, "
+          f"{counts['skipped']} skipped, {counts['failed']} failed")
+    return counts["failed"] == 0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Convert .avi files to .mp4 in parallel, skipping files "
+            "that are already converted.")
+    parser.add_argument("input_dir", nargs="?", default=".",
+                        help="Directory with .avi files (default: .)")
+    parser.add_argument("-p", "--preset",
+                        choices=[AUTO_PRESET] + list(PRESETS.keys()),
+                        default=DEFAULT_PRESET,
+                        help=f"{AUTO_PRESET}: probe every file and pick "
+                            "bitrate/maxrate/bufsize from its resolution and "
+                            "frame rate, never above the source bitrate; "
+                            + "; ".join(f"{name}: {preset['codec']} "
+                                        f"{preset['bitrate']}/{preset['maxrate']}"
+                                        f"/{preset['bufsize']}"
+                                        for name, preset in PRESETS.items())
+                            + f" (default: {DEFAULT_PRESET})")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help=f"Parallel encodes (default: {GPU_JOBS} on GPU, "
+                            f"{CPU_JOBS} on CPU)")
+    parser.add_argument("--ffmpeg", default=FFMPEG_PATH,
+                        help=f"ffmpeg executable (default: {FFMPEG_PATH})")
+    parser.add_argument("--rewrite", action="store_true",
+                        help="Convert again even if the .mp4 exists")
+    parser.add_argument("--profile", default=None,
+                        help="Write a Chrome trace-event JSON of phases and "
+                            "ffmpeg/ffprobe runs to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.profile:
+        Profiler.enable(args.profile)
+    ok = convert_all(args.input_dir, args.preset, args.jobs, args.ffmpeg,
+                     args.rewrite)
+    sys.exit(0 if ok else 1)
@@ -1,7 +1,18 @@
 import os
+import re
+import sys
+import json
+import math
+import time
+import atexit
+import shutil
+import hashlib
 import argparse
+import functools
+import threading
+import contextlib
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
 
 # ==============================================================================
@@ -266,61 +277,662 @@ class Logger:
 # End of Logger class
 # ==============================================================================
 
-def encode_audio(input_path, output_folder, input_format, output_format, bitrate, max_workers=4):
+# ==============================================================================
+# Profiler class
+# v1.1.0
+# ==============================================================================
+
+class Profiler:
+    """Records timing spans of phases and subprocesses and saves them as
+    Chrome trace-event JSON, viewable in chrome://tracing or
+    https://ui.perfetto.dev. Does nothing until enable() is called"""
+    path = None
+    events = []
+    tracks = {}
+    origin = time.perf_counter()
+
+    @staticmethod
+    def enable(path):
+        """Start recording and save to path on exit
+
+        Args:
+            path (str): Trace file path
+        """
+        Profiler.path = path
+        atexit.register(Profiler.save)
+
+    @staticmethod
+    def get_track():
+        """Get the trace row of the caller: its asyncio task, so concurrent
+        tasks do not overlap on one row, otherwise its thread"""
+        asyncio = sys.modules.get("asyncio")
+        task = None
+        if asyncio:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                pass
+        if task:
+            track, name = id(task), task.get_name()
+        else:
+            thread = threading.current_thread()
+            track, name = thread.ident, thread.name
+        Profiler.tracks[track] = name
+        return track
+
+    @staticmethod
+    def add(name, category, start, end, track, args=None):
+        """Add a complete event, start and end from time.perf_counter()"""
+        Profiler.events.append({
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - Profiler.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": track, "args": args or {},
+        })
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category="phase", **args):
+        """Context manager recording a span around its body
+
+        Args:
+            name (str): Span name
+            category (str): Span category
+            **args: Extra values shown with the span
+        """
+        if Profiler.path is None:
+            yield
+            return
+        track = Profiler.get_track()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Profiler.add(name, category, start, time.perf_counter(), track,
+                         args)
+
+    @staticmethod
+    def wrap(func):
+        """Decorator recording a span named after func for every call"""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def command(command):
+        """Context manager recording a span around running command, named
+        after its executable
+
+        Args:
+            command (list): Command line of the process
+        """
+        return Profiler.span(os.path.basename(str(command[0])), "subprocess",
+                             command=" ".join(map(str, command)))
+
+    @staticmethod
+    def save():
+        """Write the recorded spans to the trace file"""
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                     "tid": track, "args": {"name": name}}
+                    for track, name in Profiler.tracks.items()]
+        directory = os.path.dirname(os.path.abspath(Profiler.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(Profiler.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + Profiler.events,
+                       "displayTimeUnit": "ms"}, f)
+
+# ==============================================================================
+# End of Profiler class
+# ==============================================================================
+
+
+# Files smaller than this are encoded several per ffmpeg process
+BIN_SIZE = 32 * 1024 * 1024  # 32 MB
+BIN_MAX_FILES = 64
+# Discovered files are submitted right away while workers are idle, 
+# otherwise binned in chunks of up to this many
+DISCOVERY_CHUNK = 1024
+
+AUDIO_FORMATS = ["mp3", "wav", "aac", "flac", "ogg"]
+
+# EBU R128 loudness target for the loudnorm filter
+LOUDNORM_TARGET = "I=-23:TP=-1:LRA=7"
+# Measurements by content hash, so no file is analyzed twice
+LOUDNORM_CACHE_FILE = "./.cache/encode-audio/loudnorm.json"
+
+# Incremental mode: output -> source and parameters it was encoded from,
+# kept in the output folder
+MANIFEST_FILENAME = ".encode-audio-manifest.json"
+
+
+def get_available_cpus():
+    """Get number of CPUs this process may really use. Unlike os.cpu_count()
+    respects CPU affinity and the cgroup CPU quota of the container.
+
+    Returns:
+        int: Number of CPUs
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()
+        if limit != 'max':
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1, quota is -1 if unlimited
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def bin_files(files, bin_size=BIN_SIZE, max_files=BIN_MAX_FILES, min_bins=1):
+    """Group files into ffmpeg jobs. File size stands in for duration, so no 
+    probe is needed. Files of at least bin_size get their own job, smaller 
+    ones are packed together so process startup is paid once per bin.
+
+    Args:
+        min_bins (int): Cap bin_size at the total size divided by this, so 
+            there are about this many bins and no worker is left idle; 
+            max_files is left as given
+
+    Returns:
+        list: Lists of files, longest jobs first
+    """
+    sizes = {file: os.path.getsize(file) for file in files}
+    if min_bins > 1 and bin_size:
+        bin_size = max(1, min(bin_size, sum(sizes.values()) // min_bins))
+    bins = []
+    current, current_size = [], 0
+    for file in sorted(files, key=sizes.get, reverse=True):
+        if not bin_size or sizes[file] >= bin_size:
+            bins.append([file])
+            continue
+        if current and (current_size + sizes[file] > bin_size 
+                        or len(current) >= max_files):
+            bins.append(current)
+            current, current_size = [], 0
+        current.append(file)
+        current_size += sizes[file]
+    if current:
+        bins.append(current)
+    return bins
+
+
+def get_file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def measure_loudness(input_file, target=LOUDNORM_TARGET, threads=1):
+    """Run the loudnorm measurement pass.
+
+    Returns:
+        dict: loudnorm JSON stats plus 'sample_rate' of the input
+    """
+    command = [
+        "ffmpeg", "-hide_banner", "-nostdin",
+        "-threads", str(threads),
+        "-i", input_file,
+        "-map", "0:a:0",  # The stream that gets encoded
+        "-af", f"loudnorm={target}:print_format=json",
+        "-f", "null", os.devnull
+    ]
+    with Profiler.command(command):
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+    # Stats are the last JSON object ffmpeg prints
+    stats = json.loads(result.stderr[result.stderr.rindex("{"):result.stderr.rindex("}") + 1])
+    sample_rate = re.search(r"Audio: .*?(\d+) Hz", result.stderr)
+    stats["sample_rate"] = sample_rate.group(1) if sample_rate else ""
+    return stats
+
+def load_loudness_cache(cache_file):
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as f:
+        return json.load(f)
+
+def save_loudness_cache(cache_file, cache):
+    if not cache_file:
+        return
+    os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+    with open(cache_file + ".tmp", "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(cache_file + ".tmp", cache_file)
+
+def measure_loudness_cached(input_file, cache, target=LOUDNORM_TARGET, threads=1, file_hash=None):
+    """Measure a file unless the cache has it. The cache is keyed by content 
+    hash and target, so new output formats, bitrates or file names never 
+    repeat the analysis."""
+    key = f"{file_hash or get_file_hash(input_file)}|{target}"
+    if key not in cache:
+        cache[key] = measure_loudness(input_file, target, threads)
+    return cache[key]
+
+def get_loudnorm_args(stats, target=LOUDNORM_TARGET):
+    """Second-pass filter from the measurement. loudnorm upsamples to 192 kHz,
+    so the source sample rate is restored."""
+    loudnorm = f"loudnorm={target}" \
+        + f":measured_I={stats['input_i']}:measured_TP={stats['input_tp']}" \
+        + f":measured_LRA={stats['input_lra']}:measured_thresh={stats['input_thresh']}" \
+        + f":offset={stats['target_offset']}:linear=true"
+    return ["-af", loudnorm, *(["-ar", stats["sample_rate"]] if stats["sample_rate"] else [])]
+
+def get_targets(output_format, bitrate, extra_targets=()):
+    """Get output targets. Outputs are named 'name.<format>', or 
+    'name_<bitrate>.<format>' when several targets share the format.
+
+    Args:
+        extra_targets (list): (format, bitrate) pairs besides the main one
+
+    Returns:
+        list: (format, bitrate, filename suffix) tuples
+    """
+    targets = [(output_format, bitrate), *extra_targets]
+    formats = [target[0] for target in targets]
+    return [(fmt, rate, f"_{rate}" if formats.count(fmt) > 1 else "")
+            for fmt, rate in dict.fromkeys(targets)]
+
+def parse_target(target):
+    fmt, _, bitrate = target.partition(":")
+    if fmt not in AUDIO_FORMATS or not bitrate:
+        raise argparse.ArgumentTypeError(f"expected FORMAT:BITRATE with FORMAT one of {AUDIO_FORMATS}, got '{target}'")
+    return fmt, bitrate
+
+def parse_formats(formats):
+    """Parse comma-separated audio formats (e.g., 'flac,WAV')."""
+    formats = [fmt.strip().lower().lstrip(".") for fmt in formats.split(",") if fmt.strip()]
+    for fmt in formats:
+        if fmt not in AUDIO_FORMATS:
+            raise argparse.ArgumentTypeError(f"invalid format '{fmt}', choose from {AUDIO_FORMATS}")
+    return formats
+
+@Profiler.wrap
+def find_audio_files(input_path, input_formats, recursive=False, exclude=None):
+    """Yield files with any of the formats as extension, case-insensitive, 
+    as they are found, so encoding starts before the scan ends.
+
+    Args:
+        recursive (bool): Descend into subfolders
+        exclude (str): Folder to skip, e.g. an output folder inside the input
+    """
+    extensions = tuple(f".{fmt}" for fmt in input_formats)
+    exclude = os.path.abspath(exclude) if exclude else None
+    folders = [input_path]
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and os.path.abspath(entry.path) != exclude:
+                            folders.append(entry.path)
+                    elif entry.name.lower().endswith(extensions):
+                        yield entry.path
+        except OSError as exc:
+            print(f"Error reading {folder}: {exc}")
+
+def report_results(future, files):
+    try:
+        results = future.result()
+    except Exception as exc:
+        results = {file: exc for file in files}
+    for file, exc in results.items():
+        if exc is None:
+            print(f"Successfully encoded {file}")
+        else:
+            print(f"Error encoding {file}: {exc}")
+    return results
+
+def load_manifest(output_folder):
+    path = os.path.join(output_folder, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(output_folder, manifest):
+    path = os.path.join(output_folder, MANIFEST_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def get_target_params(target, loudnorm=""):
+    output_format, bitrate, _ = target
+    return f"{output_format}:{bitrate}:{loudnorm}"
+
+def get_encoded_outputs(manifest, output_folder):
+    """Index outputs by what they were encoded from, only those still on 
+    disk can be linked.
+
+    Returns:
+        dict: (source hash, params) -> outputs
+    """
+    encoded = {}
+    for output, entry in manifest.items():
+        if os.path.exists(os.path.join(output_folder, output)):
+            encoded.setdefault((entry["source_hash"], entry["params"]), []).append(output)
+    return encoded
+
+def link_output(source, destination):
+    """Hard-link an already encoded output, copy if linking is impossible."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+@Profiler.wrap
+def plan_incremental(input_files, output_folder, targets, manifest, encoded, first_by_hash, input_root=None, loudnorm=""):
+    """Decide what to encode without starting any process. A file is skipped
+    if all its outputs exist and the manifest has them from the same source 
+    (size and mtime, or content hash if those changed) and parameters. Of 
+    byte-identical sources only one is encoded, outputs of the others are 
+    linked to its outputs - or right away to outputs of an earlier run.
+
+    Args:
+        encoded (dict): get_encoded_outputs() of the manifest, kept up to date
+        first_by_hash (dict): Hash -> file being encoded from that content
+
+    Returns:
+        tuple: (files to encode, {duplicate: file it copies}, {file: hash})
+    """
+    to_encode, duplicates, hashes = [], {}, {}
+    for input_file in input_files:
+        stat = os.stat(input_file)
+        outputs = {}
+        for target in targets:
+            output_file = get_output_file(input_file, output_folder, target[0], target[2], input_root)
+            outputs[os.path.relpath(output_file, output_folder)] = get_target_params(target, loudnorm)
+        entries = [manifest.get(output) for output in outputs]
+        up_to_date = all(entry and entry["params"] == params and os.path.exists(os.path.join(output_folder, output))
+                         for (output, params), entry in zip(outputs.items(), entries))
+        if up_to_date and all(entry["source_size"] == stat.st_size and entry["source_mtime"] == stat.st_mtime_ns
+                              for entry in entries):
+            print(f"Up to date, skipping {input_file}")
+            continue
+
+        file_hash = hashes[input_file] = get_file_hash(input_file)
+        if up_to_date and all(entry["source_hash"] == file_hash for entry in entries):
+            # Only touched, remember the new stat
+            for entry in entries:
+                entry["source_size"], entry["source_mtime"] = stat.st_size, stat.st_mtime_ns
+            print(f"Up to date, skipping {input_file}")
+            continue
+        if file_hash in first_by_hash:
+            duplicates[input_file] = first_by_hash[file_hash]
+            continue
+        # The file's own outputs are never a source, they are replaced
+        sources = {output: next((source for source in encoded.get((file_hash, params), []) if source not in outputs), None)
+                   for output, params in outputs.items()}
+        if all(sources.values()):
+            try:
+                for output, source in sources.items():
+                    link_output(os.path.join(output_folder, source), os.path.join(output_folder, output))
+            except OSError as exc:
+                # Source removed meanwhile, encode instead
+                print(f"Error linking outputs for {input_file}, encoding it: {exc}")
+            else:
+                record_outputs(manifest, [input_file], output_folder, targets, hashes, input_root, loudnorm, encoded)
+                print(f"Linked outputs of identical source for {input_file}")
+                continue
+
+        first_by_hash[file_hash] = input_file
+        to_encode.append(input_file)
+        # Stale outputs are replaced, ffmpeg must not find them
+        for output in outputs:
+            if os.path.exists(os.path.join(output_folder, output)):
+                os.remove(os.path.join(output_folder, output))
+    return to_encode, duplicates, hashes
+
+def record_outputs(manifest, input_files, output_folder, targets, hashes, input_root=None, loudnorm="", encoded=None):
+    for input_file in input_files:
+        stat = os.stat(input_file)
+        for target in targets:
+            output_file = get_output_file(input_file, output_folder, target[0], target[2], input_root)
+            output = os.path.relpath(output_file, output_folder)
+            manifest[output] = {
+                "source": input_file,
+                "source_hash": hashes[input_file],
+                "source_size": stat.st_size,
+                "source_mtime": stat.st_mtime_ns,
+                "params": get_target_params(target, loudnorm),
+            }
+            if encoded is not None:
+                encoded.setdefault((hashes[input_file], manifest[output]["params"]), []).append(output)
+
+@Profiler.wrap
+def encode_audio(input_path, output_folder, input_format, output_format, bitrate, max_workers=4, threads=1, bin_size=BIN_SIZE, extra_targets=(), loudnorm="", loudnorm_cache=LOUDNORM_CACHE_FILE, recursive=False, incremental=False, overwrite=False):
     # Ensure output folder exists
     os.makedirs(output_folder, exist_ok=True)
 
-    files_to_process = []
+    targets = get_targets(output_format, bitrate, extra_targets)
+    input_formats = parse_formats(input_format) if isinstance(input_format, str) else input_format
 
     # Check if the input path is a single file or a directory
     if os.path.isfile(input_path):
         # Process single file
-        files_to_process.append(input_path)
+        files_found = [input_path]
+        input_root = None
     else:
-        # Process all files in the directory with the specified input format
-        for filename in os.listdir(input_path):
-            if filename.endswith(f".{input_format}"):
-                input_file = os.path.join(input_path, filename)
-                files_to_process.append(input_file)
-
-    # Use ThreadPoolExecutor to process files concurrently
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {
-            executor.submit(process_file, file, output_folder, output_format, bitrate): file 
-            for file in files_to_process
-        }
-
-        for future in as_completed(future_to_file):
-            file = future_to_file[future]
+        # Process all files with the specified input formats, subfolders are 
+        # mirrored in the output folder
+        files_found = find_audio_files(input_path, input_formats, recursive, exclude=output_folder)
+        input_root = input_path
+
+    manifest = load_manifest(output_folder) if incremental else {}
+    encoded = get_encoded_outputs(manifest, output_folder)
+    duplicates, hashes, first_by_hash = {}, {}, {}
+    loudness_cache = load_loudness_cache(loudnorm_cache) if loudnorm else {}
+
+    def encode_bin(files):
+        # Measured by the encode workers, so both passes share one budget of
+        # max_workers ffmpeg processes
+        filters, results = {}, {}
+        for file in files if loudnorm else []:
             try:
-                future.result()
-                print(f"Successfully encoded {file}")
+                stats = measure_loudness_cached(file, loudness_cache, loudnorm, threads, hashes.get(file))
+                filters[file] = get_loudnorm_args(stats, loudnorm)
             except Exception as exc:
-                print(f"Error encoding {file}: {exc}")
-
-def process_file(input_file, output_folder, output_format, bitrate):
-    # Generate the output filename and path
-    output_filename = os.path.splitext(os.path.basename(input_file))[0] + f".{output_format}"
-    output_file = os.path.join(output_folder, output_filename)
-
-    # Use ffmpeg to encode the file
+                results[file] = RuntimeError(f"loudness measurement failed: {exc}")
+        files = [file for file in files if file not in results]
+        if files:
+            # Incremental mode already removed the outputs it replaces
+            results.update(process_bin(files, output_folder, targets, threads, filters, input_root, overwrite or incremental))
+        return results
+
+    def submit(files_to_process):
+        if incremental:
+            files_to_process, new_duplicates, new_hashes = plan_incremental(files_to_process, output_folder, targets, manifest, encoded, first_by_hash, input_root, loudnorm)
+            duplicates.update(new_duplicates)
+            hashes.update(new_hashes)
+        elif not overwrite:
+            for file in list(files_to_process):
+                if all(os.path.exists(get_output_file(file, output_folder, fmt, suffix, input_root)) for fmt, _, suffix in targets):
+                    print(f"Output exists, skipping {file}")
+                    files_to_process.remove(file)
+        for files in bin_files(files_to_process, bin_size, min_bins=max_workers):
+            future_to_bin[executor.submit(encode_bin, files)] = files
+
+    def finish(future, files):
+        results = report_results(future, files)
+        if not incremental:
+            return
+        succeeded = [file for file, exc in results.items() if exc is None]
+        record_outputs(manifest, succeeded, output_folder, targets, hashes, input_root, loudnorm, encoded)
+        for file in results:
+            # Later copies link to the outputs, or encode if it failed
+            first_by_hash.pop(hashes[file], None)
+        for duplicate, original in list(duplicates.items()):
+            if original not in results:
+                continue
+            del duplicates[duplicate]
+            if original not in succeeded:
+                print(f"Error encoding {duplicate}: identical source {original} failed")
+                continue
+            for output_format, _, suffix in targets:
+                link_output(get_output_file(original, output_folder, output_format, suffix, input_root),
+                            get_output_file(duplicate, output_folder, output_format, suffix, input_root))
+            record_outputs(manifest, [duplicate], output_folder, targets, hashes, input_root, loudnorm, encoded)
+            print(f"Linked outputs of identical source {original} for {duplicate}")
+
+    try:
+        # Use ThreadPoolExecutor to process files concurrently
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_bin, pending = {}, []
+            for file in files_found:
+                pending.append(file)
+                for future in [future for future in future_to_bin if future.done()]:
+                    finish(future, future_to_bin.pop(future))
+                # Idle workers get files as they are found, busy ones get 
+                # small files packed into bins
+                if len(future_to_bin) < max_workers or len(pending) >= DISCOVERY_CHUNK:
+                    submit(pending)
+                    pending = []
+
+                # Keep the scan just ahead of the encoders
+                while len(future_to_bin) > max_workers * 2:
+                    done, _ = wait(future_to_bin, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future, future_to_bin.pop(future))
+            if pending:
+                submit(pending)
+
+            for future in as_completed(future_to_bin):
+                finish(future, future_to_bin[future])
+        for duplicate, original in duplicates.items():
+            print(f"Error encoding {duplicate}: identical source {original} was not encoded")
+    finally:
+        # Also after an interrupt, so finished outputs are not redone
+        if incremental:
+            save_manifest(output_folder, manifest)
+        # Once per run, not per file
+        if loudnorm:
+            save_loudness_cache(loudnorm_cache, loudness_cache)
+
+def get_output_file(input_file, output_folder, output_format, suffix="", input_root=None):
+    """Get output path. With input_root, the input's subfolder below it is 
+    recreated in output_folder."""
+    if input_root:
+        output_folder = os.path.join(output_folder, os.path.relpath(os.path.dirname(input_file), input_root))
+        os.makedirs(output_folder, exist_ok=True)
+    output_filename = os.path.splitext(os.path.basename(input_file))[0] + f"{suffix}.{output_format}"
+    return os.path.normpath(os.path.join(output_folder, output_filename))
+
+@Profiler.wrap
+def process_bin(input_files, output_folder, targets, threads=1, filters=None, input_root=None, overwrite=False):
+    """Encode several files to every target with one ffmpeg process. If it 
+    fails, the files are retried one by one so only the broken ones are 
+    reported. Existing outputs are replaced only with overwrite, otherwise 
+    the file fails.
+
+    Returns:
+        dict: Input file -> exception, None if encoded
+    """
+    if len(input_files) == 1:
+        try:
+            process_file(input_files[0], output_folder, targets, threads, filters, input_root, overwrite)
+            return {input_files[0]: None}
+        except Exception as exc:
+            return {input_files[0]: exc}
+
+    command = ["ffmpeg", "-nostdin", "-y" if overwrite else "-n"]
+    for input_file in input_files:
+        command += ["-threads", str(threads), "-i", input_file]
+    # Outputs for every input, first audio stream and tags only
+    output_files = []
+    for i, input_file in enumerate(input_files):
+        for output_format, bitrate, suffix in targets:
+            output_file = get_output_file(input_file, output_folder, output_format, suffix, input_root)
+            output_files.append(output_file)
+            command += ["-map", f"{i}:a:0", "-map_metadata", str(i), *(filters or {}).get(input_file, []), "-threads", str(threads), "-b:a", bitrate, output_file]
+    existed = {file for file in output_files if os.path.exists(file)}
+    try:
+        with Profiler.command(command):
+            subprocess.run(command, check=True)
+        return {file: None for file in input_files}
+    except subprocess.CalledProcessError:
+        # Drop what this bin wrote, so the retries do not hit existing files
+        for output_file in output_files:
+            if output_file not in existed and os.path.exists(output_file):
+                os.remove(output_file)
+        results = {}
+        for input_file in input_files:
+            results.update(process_bin([input_file], output_folder, targets, threads, filters, input_root, overwrite))
+        return results
+
+@Profiler.wrap
+def process_file(input_file, output_folder, targets, threads=1, filters=None, input_root=None, overwrite=False):
+    # Use ffmpeg to encode the file, decoded once for all targets
     command = [
         "ffmpeg", 
+        "-nostdin",  # Never prompt
+        "-y" if overwrite else "-n",  # Replace or fail on existing outputs
+        "-threads", str(threads),  # Decoder threads
         "-i", input_file,  # Input file
-        "-b:a", bitrate,   # Bitrate
-        output_file        # Output file
     ]
-    subprocess.run(command, check=True)
-
-if __name__ == "__main__":
+    for output_format, bitrate, suffix in targets:
+        # Generate the output filename and path
+        output_file = get_output_file(input_file, output_folder, output_format, suffix, input_root)
+        command += [
+            "-map", "0:a:0",  # First audio stream, same as a bin
+            "-map_metadata", "0",  # Tags
+            *(filters or {}).get(input_file, []),  # Normalization
+            "-threads", str(threads),  # Encoder threads
+            "-b:a", bitrate,   # Bitrate
+            output_file        # Output file
+        ]
+    with Profiler.command(command):
+        subprocess.run(command, check=True)
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Encode audio files using FFmpeg asynchronously. You can specify a single file or a folder.")
     parser.add_argument("input_path", type=str, help="Path to the input file or folder containing audio files.")
     parser.add_argument("output_folder", type=str, help="Path to the output folder where encoded files will be saved.")
-    parser.add_argument("input_format", type=str, choices=["mp3", "wav", "aac", "flac", "ogg"], help="Input format (e.g., 'mp3', 'wav').")
-    parser.add_argument("output_format", type=str, choices=["mp3", "wav", "aac", "flac", "ogg"], help="Output format (e.g., 'mp3', 'wav').")
+    parser.add_argument("input_format", type=parse_formats, help=f"Input formats, comma-separated and case-insensitive (e.g., 'mp3', 'flac,wav'). Choices: {', '.join(AUDIO_FORMATS)}.")
+    parser.add_argument("output_format", type=str, choices=AUDIO_FORMATS, help="Output format (e.g., 'mp3', 'wav').")
     parser.add_argument("bitrate", type=str, help="Bitrate for the output files (e.g., '192k').")
-    parser.add_argument("--max-workers", type=int, default=os.cpu_count(), help="Maximum number of threads to use (default: os.cpu_count()).")
+    parser.add_argument("--max-workers", type=int, default=get_available_cpus(), help="Maximum number of parallel ffmpeg processes (default: CPUs available to the process, respecting affinity and cgroup quota).")
+    parser.add_argument("--threads", type=int, default=1, help="Threads per ffmpeg process (default: 1, parallelism comes from --max-workers).")
+    parser.add_argument("--bin-size", type=int, default=BIN_SIZE // 1024 // 1024, help=f"Encode files smaller than this many MB together, up to {BIN_MAX_FILES} per ffmpeg process; 0 disables (default: {BIN_SIZE // 1024 // 1024}).")
+    parser.add_argument("--target", type=parse_target, action="append", default=[], metavar="FORMAT:BITRATE", help="Additional output (e.g., 'mp3:320k', 'ogg:192k'), may be repeated. All outputs are encoded from a single decode of the input.")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Scan subfolders too; the folder structure is mirrored in the output folder.")
+    parser.add_argument("--incremental", action="store_true", help=f"Skip files whose outputs are up to date according to '{MANIFEST_FILENAME}' in the output folder, encode byte-identical sources once and link the other outputs to it. Outdated outputs are replaced.")
+    parser.add_argument("--overwrite", action="store_true", help="Replace existing outputs. Without it, files whose outputs all exist are skipped and partly existing outputs fail the file.")
+    parser.add_argument("--loudnorm", type=str, nargs="?", const=LOUDNORM_TARGET, default="", metavar="TARGET", help=f"Normalize loudness (EBU R128, two-pass loudnorm) to TARGET (default: '{LOUDNORM_TARGET}'). Measurements run in parallel and are cached by content hash.")
+    parser.add_argument("--loudnorm-cache", type=str, default=LOUDNORM_CACHE_FILE, help=f"Loudness measurement cache file (default: '{LOUDNORM_CACHE_FILE}').")
+    parser.add_argument("--profile", type=str, default="", help="Write a Chrome trace-event JSON of phases and ffmpeg runs to this file (default: off).")
+
+    args = parser.parse_args(argv)
+    if args.profile:
+        Profiler.enable(args.profile)
 
-    args = parser.parse_args()
+    encode_audio(args.input_path, args.output_folder, args.input_format, args.output_format, args.bitrate, args.max_workers, args.threads, args.bin_size * 1024 * 1024, args.target, args.loudnorm, args.loudnorm_cache, args.recursive, args.incremental, args.overwrite)
 
-    encode_audio(args.input_path, args.output_folder, args.input_format, args.output_format, args.bitrate, args.max_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import sqlite3
+import argparse
+import datetime
+import traceback
+import importlib.util
+import multiprocessing
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Scripts jobs can run, each has main(argv)
+SCRIPTS = ["encode-video", "encode-audio", "video-concat-mp4"]
+
+# Shared by every submitter and the daemon, whatever their working directory
+QUEUE_PATH = os.path.join(SCRIPT_DIR, ".cache", "encode-queue", "queue.db")
+LOG_DIR_NAME = "logs"
+
+DEFAULT_WORKERS = 2
+# Seconds an idle worker waits before looking at the queue again
+POLL_INTERVAL = 0.5
+# Seconds workers get to stop their job on shutdown before they are killed
+STOP_TIMEOUT = 10
+
+STATUSES = ["queued", "running", "done", "failed", "cancelled"]
+
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"{timestamp} {message}", flush=True)
+
+
+def open_queue(queue_path):
+    """Open the queue database, create it if needed"""
+    os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+    # Autocommit, claiming a job takes an explicit write transaction
+    conn = sqlite3.connect(queue_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        script TEXT NOT NULL,
+        args TEXT NOT NULL,
+        cwd TEXT NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'queued',
+        submitted REAL NOT NULL,
+        started REAL,
+        finished REAL,
+        worker INTEGER,
+        returncode INTEGER,
+        error TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_status "
+                 "ON jobs (status, priority DESC, id)")
+    return conn
+
+
+def get_log_path(queue_path, job_id):
+    return os.path.join(os.path.dirname(os.path.abspath(queue_path)),
+                        LOG_DIR_NAME, f"{job_id}.log")
+
+
+def get_script_name(script):
+    """Get the script name from 'encode-video', 'encode-video.py' or a path"""
+    name = os.path.splitext(os.path.basename(script))[0]
+    if name not in SCRIPTS:
+        raise ValueError(f"unknown script '{script}', choose from {SCRIPTS}")
+    return name
+
+
+def submit(queue_path, script, args, priority=0, cwd=None):
+    """Add a job, return its id"""
+    conn = open_queue(queue_path)
+    try:
+        cursor = conn.execute(
+            "INSERT INTO jobs (script, args, cwd, priority, submitted) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (get_script_name(script), json.dumps(list(args)),
+             os.path.abspath(cwd or os.getcwd()), priority, time.time()))
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def claim_job(conn, worker):
+    """Mark the next queued job, highest priority first, as running by
+    worker and return (id, script, args, cwd), None if the queue is empty"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT id, script, args, cwd FROM jobs WHERE status = 'queued' "
+            "ORDER BY priority DESC, id LIMIT 1").fetchone()
+        if row:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started = ?, worker = ? "
+                "WHERE id = ?", (time.time(), worker, row[0]))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+
+def finish_job(conn, job_id, worker, returncode, error=None):
+    # A job requeued by a shutting down daemon stays queued
+    conn.execute(
+        "UPDATE jobs SET status = ?, finished = ?, returncode = ?, error = ? "
+        "WHERE id = ? AND status = 'running' AND worker = ?",
+        ("done" if returncode == 0 else "failed", time.time(), returncode,
+         error, job_id, worker))
+
+
+def requeue_jobs(conn, job_ids):
+    conn.executemany(
+        "UPDATE jobs SET status = 'queued', started = NULL, finished = NULL, "
+        "worker = NULL, returncode = NULL, error = NULL WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+
+def get_running_jobs(conn, workers):
+    """Get ids of jobs running on the given worker pids"""
+    return [job_id for job_id, worker in conn.execute(
+        "SELECT id, worker FROM jobs WHERE status = 'running'")
+        if worker in workers]
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+
+def load_script(name):
+    """Import a hyphenated script as a module, its __main__ block is not
+    run"""
+    spec = importlib.util.spec_from_file_location(
+        name.replace("-", "_"), os.path.join(SCRIPT_DIR, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def save_profile(module):
+    """Save the trace of a job run with --profile and reset the script's
+    Profiler for the next job. Workers exit with os._exit(), so the atexit
+    hook enable() registered would never run"""
+    profiler = getattr(module, "Profiler", None)
+    if not profiler or profiler.path is None:
+        return
+    atexit.unregister(profiler.save)
+    try:
+        profiler.save()
+    except OSError:
+        traceback.print_exc()
+    profiler.path, profiler.events, profiler.tracks = None, [], {}
+    profiler.origin = time.perf_counter()
+
+
+def run_job(module, args, cwd, log_path):
+    """Run module.main(args) in cwd with stdout and stderr, also of its
+    ffmpeg children, going to log_path. Return (return code, error)"""
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    handlers = {sig: signal.getsignal(sig)
+                for sig in (signal.SIGINT, signal.SIGTERM)}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    with open(log_path, "ab") as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+    try:
+        os.chdir(cwd)
+        module.main(list(args))
+        return 0, None
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0, None
+        return 1, str(e.code)
+    except Exception as e:
+        traceback.print_exc()
+        return 1, f"{type(e).__name__}: {e}"
+    finally:
+        save_profile(module)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved in zip((1, 2), saved_fds):
+            os.dup2(saved, fd)
+            os.close(saved)
+        # Scripts install their own handlers for the job
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+
+
+def worker_main(queue_path, stop, poll=POLL_INTERVAL):
+    """Worker process: run queued jobs one at a time until stop is set.
+    Scripts are imported once and stay loaded, with their probe caches"""
+    if hasattr(os, "setsid"):
+        # Own process group: Ctrl-C reaches the daemon only, and the
+        # daemon can signal a worker together with its ffmpeg children
+        os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    modules = {name: load_script(name) for name in SCRIPTS}
+    conn = open_queue(queue_path)
+    worker = os.getpid()
+    while not stop.is_set():
+        job = claim_job(conn, worker)
+        if not job:
+            stop.wait(poll)
+            continue
+        job_id, script, args, cwd = job
+        log(f"Worker {worker}: job {job_id} started: {script} "
+            + " ".join(json.loads(args)))
+        returncode, error = run_job(modules[script], json.loads(args), cwd,
+                                    get_log_path(queue_path, job_id))
+        finish_job(conn, job_id, worker, returncode, error)
+        log(f"Worker {worker}: job {job_id} finished with {returncode}"
+            + (f": {error}" if error else ""))
+
+
+def start_worker(queue_path, stop, poll):
+    process = multiprocessing.Process(target=worker_main,
+                                      args=(queue_path, stop, poll))
+    process.start()
+    return process
+
+
+def stop_workers(processes):
+    for process in processes:
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGTERM)
+            else:
+                process.terminate()
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for process in processes:
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            process.kill()
+            process.join()
+
+
+def serve(queue_path, workers=DEFAULT_WORKERS, poll=POLL_INTERVAL):
+    """Run workers until interrupted, restarting any that die. Jobs running
+    on shutdown or on a dead worker are queued again"""
+    conn = open_queue(queue_path)
+    stale = [job_id for job_id, worker in conn.execute(
+        "SELECT id, worker FROM jobs WHERE status = 'running'")
+        if not worker or not is_process_alive(worker)]
+    if stale:
+        requeue_jobs(conn, stale)
+        log(f"Requeued {len(stale)} job(s) of a previous daemon")
+
+    def handle_sigterm(sig, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    stop = multiprocessing.Event()
+    processes = [start_worker(queue_path, stop, poll) for _ in range(workers)]
+    log(f"Serving '{queue_path}' with {workers} worker(s)")
+    try:
+        while True:
+            for i, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                # Its ffmpeg children outlive it in its process group
+                if hasattr(os, "killpg"):
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                lost = get_running_jobs(conn, {process.pid})
+                requeue_jobs(conn, lost)
+                log(f"Worker {process.pid} exited with {process.exitcode}, "
+                    f"requeued {len(lost)} job(s)")
+                processes[i] = start_worker(queue_path, stop, poll)
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        log("Stopping workers...")
+    finally:
+        # Cleanup is bounded by STOP_TIMEOUT, a second signal must not cut
+        # it short and leave jobs marked running
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        stop.set()
+        running = get_running_jobs(conn, {p.pid for p in processes})
+        stop_workers(processes)
+        requeue_jobs(conn, running)
+        log(f"Stopped, requeued {len(running)} running job(s)")
+        conn.close()
+
+
+def print_jobs(queue_path, statuses):
+    conn = open_queue(queue_path)
+    try:
+        rows = conn.execute(
+            "SELECT id, priority, status, script, args, submitted, started, "
+            "finished, returncode FROM jobs WHERE status IN ({}) "
+            "ORDER BY status != 'running', priority DESC, id".format(
+                ",".join("?" * len(statuses))), statuses).fetchall()
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    finally:
+        conn.close()
+    for job_id, priority, status, script, args, submitted, started, \
+            finished, returncode in rows:
+        if status == "cancelled":
+            took = ""
+        elif finished:
+            took = f"{finished - started:.1f}s, exit {returncode}"
+        elif started:
+            took = f"running {time.time() - started:.1f}s"
+        else:
+            took = f"waiting {time.time() - submitted:.1f}s"
+        print(f"{job_id:>6} {priority:>4} {status:<9} {took:<22} {script} "
+              + " ".join(json.loads(args)))
+    print(", ".join(f"{counts.get(status, 0)} {status}" for status in STATUSES))
+
+
+def cancel(queue_path, job_ids):
+    """Cancel queued jobs, return how many were cancelled"""
+    conn = open_queue(queue_path)
+    try:
+        return sum(conn.execute(
+            "UPDATE jobs SET status = 'cancelled', finished = ? "
+            "WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)).rowcount for job_id in job_ids)
+    finally:
+        conn.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Job queue for the encoding scripts: a daemon with a "
+            "pool of long-running workers runs submitted jobs in-process, "
+            "without interpreter startup per job, keeping probe results "
+            "cached across jobs.")
+    parser.add_argument("--queue", default=QUEUE_PATH,
+                        help=f"Queue database (default: {QUEUE_PATH})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser(
+        "serve", help="Run the daemon until Ctrl-C or SIGTERM")
+    serve_parser.add_argument("-j", "--workers", type=int,
+                              default=DEFAULT_WORKERS,
+                              help=f"Worker processes, each runs one job at "
+                                  f"a time (default: {DEFAULT_WORKERS})")
+    serve_parser.add_argument("--poll", type=float, default=POLL_INTERVAL,
+                              help=f"Seconds between queue checks of an idle "
+                                  f"worker (default: {POLL_INTERVAL})")
+
+    submit_parser = commands.add_parser(
+        "submit", help="Queue a job, e.g.: submit -p 5 encode-video "
+            "in.avi --codec hevc_nvenc. Relative paths are resolved against "
+            "the current directory")
+    submit_parser.add_argument("-p", "--priority", type=int, default=0,
+                               help="Higher runs first (default: 0)")
+    submit_parser.add_argument("script", help=f"One of {', '.join(SCRIPTS)}")
+    submit_parser.add_argument("args", nargs=argparse.REMAINDER,
+                               help="Arguments for the script")
+
+    status_parser = commands.add_parser("status", help="List jobs")
+    status_parser.add_argument("-a", "--all", action="store_true",
+                               help="Also list finished and cancelled jobs")
+
+    cancel_parser = commands.add_parser("cancel", help="Cancel queued jobs")
+    cancel_parser.add_argument("ids", type=int, nargs="+", help="Job ids")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    # Jobs chdir into their own cwd, keep the queue (and logs) anchored here
+    args.queue = os.path.abspath(args.queue)
+    if args.command == "serve":
+        serve(args.queue, max(1, args.workers), args.poll)
+    elif args.command == "submit":
+        try:
+            job_id = submit(args.queue, args.script, args.args, args.priority)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(2)
+        print(job_id)
+    elif args.command == "status":
+        print_jobs(args.queue, STATUSES if args.all else ["queued", "running"])
+    elif args.command == "cancel":
+        cancelled = cancel(args.queue, args.ids)
+        print(f"Cancelled {cancelled} of {len(args.ids)} job(s)")
+        sys.exit(0 if cancelled == len(args.ids) else 1)
@@ -1,11 +1,63 @@
 #!/usr/bin/env python3
 
-import os, argparse, subprocess
+import os, sys, argparse, subprocess
+import shutil
+import signal
 import datetime
+import time
+import csv
+import itertools
+import statistics
+import hashlib
+import json
+import tempfile
+import threading
+import concurrent.futures
+import shlex
+import select
+import struct
+import ctypes
+import ctypes.util
+import functools
+import atexit
+import contextlib
+from functools import lru_cache
 
 # Directory where ffmpeg.exe is located
 FFMPEG_PATH = r"ffmpeg"
 
+# Rate-control profiles, see get_rate_control_args()
+RATE_CONTROL_PROFILES = {
+    'bitrate': 'single-pass average bitrate (-b:v)',
+    'crf': 'constant quality (-crf, -cq for NVENC)',
+    'capped-crf': 'constant quality capped by -maxrate/-bufsize',
+    '2pass': 'two-pass average bitrate, first-pass stats are cached ' \
+        + '(x264/x265, NVENC runs both passes in one encode)',
+}
+DEFAULT_CRF = 23
+# Where first-pass logs are kept between runs
+PASS_CACHE_DIR = './.cache/encode-video/passlog'
+# Decode-scale-encode pipelines, see build_ffmpeg_command()
+PIPELINES = ['auto', 'gpu', 'cpu']
+# Hardware scale filters in order of preference
+HW_SCALE_FILTERS = ['scale_cuda', 'scale_npp']
+# Auto-bitrate: test-encoded segments per title and their length in seconds
+AUTO_BITRATE_SAMPLES = 3
+AUTO_BITRATE_SECONDS = 5
+AUTO_BITRATE_CACHE_FILE = './.cache/encode-video/bitrate.json'
+# Synthetic sources for the benchmark, no media or GPU needed
+BENCHMARK_VIDEO_SOURCE = 'testsrc2=size={resolution}:rate={fps}:duration={duration}'
+BENCHMARK_AUDIO_SOURCE = 'sine=frequency=1000:duration={duration}'
+# Probe results are cached per file version (path, size, mtime), a worker
+# of encode-queue.py keeps them across jobs
+PROBE_CACHE_SIZE = 4096
+# Watch mode: 'inotify' reacts to close-write/move-in events (Linux),
+# 'poll' waits for files to settle, 'auto' falls back to 'poll'
+WATCHERS = ['auto', 'inotify', 'poll']
+# Seconds a file's size and mtime must stay unchanged to count as finished
+WATCH_SETTLE_SECONDS = 5
+WATCH_POLL_INTERVAL = 1
+
 # ==============================================================================
 # Logger class
 # by Kseen715
@@ -268,61 +320,650 @@ class Logger:
 # End of Logger class
 # ==============================================================================
 
+# ==============================================================================
+# Profiler class
+# v1.1.0
+# ==============================================================================
+
+class Profiler:
+    """Records timing spans of phases and subprocesses and saves them as
+    Chrome trace-event JSON, viewable in chrome://tracing or
+    https://ui.perfetto.dev. Does nothing until enable() is called"""
+    path = None
+    events = []
+    tracks = {}
+    origin = time.perf_counter()
+
+    @staticmethod
+    def enable(path):
+        """Start recording and save to path on exit
+
+        Args:
+            path (str): Trace file path
+        """
+        Profiler.path = path
+        atexit.register(Profiler.save)
+
+    @staticmethod
+    def get_track():
+        """Get the trace row of the caller: its asyncio task, so concurrent
+        tasks do not overlap on one row, otherwise its thread"""
+        asyncio = sys.modules.get("asyncio")
+        task = None
+        if asyncio:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                pass
+        if task:
+            track, name = id(task), task.get_name()
+        else:
+            thread = threading.current_thread()
+            track, name = thread.ident, thread.name
+        Profiler.tracks[track] = name
+        return track
+
+    @staticmethod
+    def add(name, category, start, end, track, args=None):
+        """Add a complete event, start and end from time.perf_counter()"""
+        Profiler.events.append({
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - Profiler.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": track, "args": args or {},
+        })
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category="phase", **args):
+        """Context manager recording a span around its body
+
+        Args:
+            name (str): Span name
+            category (str): Span category
+            **args: Extra values shown with the span
+        """
+        if Profiler.path is None:
+            yield
+            return
+        track = Profiler.get_track()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Profiler.add(name, category, start, time.perf_counter(), track,
+                         args)
+
+    @staticmethod
+    def wrap(func):
+        """Decorator recording a span named after func for every call"""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def command(command):
+        """Context manager recording a span around running command, named
+        after its executable
+
+        Args:
+            command (list): Command line of the process
+        """
+        return Profiler.span(os.path.basename(str(command[0])), "subprocess",
+                             command=" ".join(map(str, command)))
+
+    @staticmethod
+    def save():
+        """Write the recorded spans to the trace file"""
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                     "tid": track, "args": {"name": name}}
+                    for track, name in Profiler.tracks.items()]
+        directory = os.path.dirname(os.path.abspath(Profiler.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(Profiler.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + Profiler.events,
+                       "displayTimeUnit": "ms"}, f)
+
+# ==============================================================================
+# End of Profiler class
+# ==============================================================================
+
+
+def cache_probe(func):
+    """Cache func(video_file) by path, size and modification time, so an
+    unchanged file is probed once per process.
+
+    Args:
+        func (callable): Probe taking the file path
+    """
+    @lru_cache(maxsize=PROBE_CACHE_SIZE)
+    def cached(path, size, mtime):
+        return func(path)
+
+    @functools.wraps(func)
+    def wrapper(video_file):
+        try:
+            stat = os.stat(video_file)
+        except OSError:
+            return func(video_file)
+        return cached(os.path.abspath(video_file), stat.st_size, 
+                      stat.st_mtime_ns)
+    return wrapper
+
+
+@cache_probe
+@Profiler.wrap
+def get_video_info(video_file):
+    """Get video stream bitrate, container bitrate, size and duration in one
+    ffprobe call. Missing values ('N/A') are returned as 0.
+
+    Returns:
+        dict: 'bit_rate', 'format_bit_rate', 'size', 'duration'
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', \
+        '-show_entries', 'stream=bit_rate:format=bit_rate,size,duration', \
+        '-of', 'json', video_file]
+    with Profiler.command(command):
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+    metadata = json.loads(result.stdout.decode() or '{}')
+    streams = metadata.get('streams') or [{}]
+    fmt = metadata.get('format', {})
+
+    def number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0
+    return {
+        'bit_rate': int(number(streams[0].get('bit_rate'))),
+        'format_bit_rate': int(number(fmt.get('bit_rate'))),
+        'size': int(number(fmt.get('size'))),
+        'duration': number(fmt.get('duration')),
+    }
+
+
 def get_video_bitrate(video_file):
     Logger.debug(f"Getting bitrate of {video_file}...")
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', \
-        'stream=bit_rate', '-of', 'default=noprint_wrappers=1:nokey=1', \
-        video_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    return int(result.stdout.decode().strip())
+    info = get_video_info(video_file)
+    # Stream bitrate is often missing (MKV/WebM), fall back to the container
+    bitrate = info['bit_rate'] or info['format_bit_rate']
+    if not bitrate and info['duration'] > 0:
+        bitrate = int(info['size'] * 8 / info['duration'])
+    if not bitrate:
+        raise ValueError(f"Could not get bitrate of {video_file}")
+    return bitrate
 
 
+@cache_probe
 def get_video_audio_codec(video_file):
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', \
-        'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', \
-        video_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', \
+        '-show_entries', 'stream=codec_name', \
+        '-of', 'default=noprint_wrappers=1:nokey=1', video_file]
+    with Profiler.command(command):
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
     return result.stdout.decode().strip()
 
-# Function to convert AVI to MP4
-def convert(filename, output_folder, output_format, codec, bitrate, 
-            audio_codec, scale=None, fps=None, rewrite=False):
-    base_name = os.path.splitext(os.path.basename(filename))[0]
-    # if output_folder is folder 
+def parse_bitrate(bitrate):
+    """Parse bitrate string to bits per second.
+
+    Args:
+        bitrate (str): Bitrate (e.g., '192k', '2M', '4000000')
+
+    Returns:
+        int: Bitrate in bits per second
+    """
+    bitrate = str(bitrate).strip()
+    multipliers = {'k': 1000, 'm': 1000 ** 2, 'g': 1000 ** 3}
+    if bitrate and bitrate[-1].lower() in multipliers:
+        return int(float(bitrate[:-1]) * multipliers[bitrate[-1].lower()])
+    return int(float(bitrate))
+
+
+def get_codec_family(codec):
+    """Get encoder family of the codec, rate-control options differ per family.
+
+    Args:
+        codec (str): Video codec (e.g., 'hevc_nvenc', 'h264')
+
+    Returns:
+        str: 'nvenc', 'x264', 'x265' or 'other'
+    """
+    if 'nvenc' in codec:
+        return 'nvenc'
+    if codec in ('h264', 'libx264'):
+        return 'x264'
+    if codec in ('hevc', 'h265', 'libx265'):
+        return 'x265'
+    return 'other'
+
+
+def get_rate_control_args(rate_control, codec, bitrate, crf=None, 
+                          maxrate=None, bufsize=None):
+    """Get ffmpeg rate-control arguments for the profile.
+
+    Args:
+        rate_control (str): Profile name, one of RATE_CONTROL_PROFILES
+        codec (str): Video codec
+        bitrate (str): Target bitrate, used by 'bitrate' and '2pass'
+        crf (int): Quality for 'crf' and 'capped-crf'
+        maxrate (str): Max bitrate for 'capped-crf', bitrate if empty
+        bufsize (str): VBV buffer size for 'capped-crf', 2x maxrate if empty
+
+    Returns:
+        list: ffmpeg arguments
+    """
+    family = get_codec_family(codec)
+    if rate_control == '2pass' and family == 'other':
+        # Other encoders ignore -pass, the first pass would be wasted
+        raise ValueError(f"'2pass' needs an x264, x265 or NVENC codec, " \
+                         + f"got '{codec}'")
+    if rate_control == '2pass' and family == 'nvenc':
+        # Both passes inside one encode, nothing to cache
+        return ['-rc', 'vbr', '-multipass', 'fullres', '-b:v', str(bitrate)]
+    if rate_control in ('bitrate', '2pass'):
+        return ['-b:v', str(bitrate)]
+    if rate_control not in ('crf', 'capped-crf'):
+        raise ValueError(f"Unknown rate-control profile: {rate_control}")
+
+    crf = DEFAULT_CRF if crf is None else crf
+    if family == 'nvenc':
+        args = ['-rc', 'vbr', '-cq', str(crf), '-b:v', '0']
+    else:
+        args = ['-crf', str(crf)]
+    if rate_control == 'capped-crf':
+        maxrate = maxrate or bitrate
+        bufsize = bufsize or 2 * parse_bitrate(maxrate)
+        args += ['-maxrate', str(maxrate), '-bufsize', str(bufsize)]
+    return args
+
+
+def get_pass_log_prefix(filename, codec, scale=None, fps=None, 
+                        pass_cache=PASS_CACHE_DIR):
+    """Get first-pass log prefix for the source. The key does not include the
+    bitrate, so re-encodes at other bitrates reuse the same first pass.
+
+    Args:
+        filename (str): Source file
+        codec (str): Video codec
+        scale (str): Scale filter value
+        fps (int): Output frames per second
+
+    Returns:
+        str: Log file prefix inside pass_cache
+    """
+    stat = os.stat(filename)
+    key = f"{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}" \
+        + f"|{codec}|{scale}|{fps}"
+    os.makedirs(pass_cache, exist_ok=True)
+    return os.path.join(pass_cache, hashlib.sha1(key.encode()).hexdigest())
+
+
+def get_pass_log_files(prefix, codec):
+    if get_codec_family(codec) == 'x265':
+        return [f"{prefix}.log", f"{prefix}.log.cutree"]
+    return [f"{prefix}-0.log", f"{prefix}-0.log.mbtree"]
+
+
+def get_pass_args(codec, pass_num, prefix):
+    if get_codec_family(codec) == 'x265':
+        return ['-x265-params', f"pass={pass_num}:stats={prefix}.log"]
+    return ['-pass', str(pass_num), '-passlogfile', prefix]
+
+
+@lru_cache(maxsize=None)
+def get_hw_scale_filter():
+    """Get the first hardware scale filter ffmpeg was built with.
+
+    Returns:
+        str: Filter name, empty if there is none
+    """
+    command = [FFMPEG_PATH, '-hide_banner', '-filters']
+    try:
+        with Profiler.command(command):
+            result = subprocess.run(command, stdout=subprocess.PIPE, 
+                                    stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        return ''
+    filters = [line.split()[1] for line in result.stdout.decode().splitlines() 
+               if len(line.split()) > 1]
+    for hw_filter in HW_SCALE_FILTERS:
+        if hw_filter in filters:
+            return hw_filter
+    return ''
+
+
+def build_ffmpeg_command(filename, output_file, codec, audio_codec, 
+                         scale=None, fps=None, rewrite=False, 
+                         rate_control_args=(), pass_args=(), pipeline='cpu',
+                         hw_scale_filter='scale_cuda'):
+    """Build the encode command. Does not touch the GPU or the files, so the
+    result can be checked on any machine.
+
+    Args:
+        pipeline (str): 'gpu' keeps decoded frames on the device and scales 
+            them with hw_scale_filter, 'cpu' scales on the host
+        hw_scale_filter (str): Hardware scale filter for the 'gpu' pipeline
+
+    Returns:
+        list: ffmpeg command
+    """
+    nvenc = 'nvenc' in codec
+    if pipeline == 'gpu':
+        hwaccel_args = ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+        scale_args = ["-vf", f"{hw_scale_filter}={scale}"] if scale else []
+    else:
+        hwaccel_args = ['-hwaccel', 'cuda' if nvenc else 'auto']
+        scale_args = ["-vf", f"scale={scale}"] if scale else []
+    return [
+        FFMPEG_PATH,
+        '-hide_banner',
+        '-loglevel', *(['error'] if LOG_LEVEL < 5 else ['info']),
+        '-stats',
+        '-y' if rewrite else '-n',
+        *hwaccel_args,
+        "-i", filename,
+        "-c:v", codec,
+        *scale_args,
+        *(["-r", str(fps)] if fps else []),
+        *rate_control_args,
+        *pass_args,
+        "-c:a", audio_codec,
+        '-strict', 'experimental',
+        "-map_metadata", "0",
+        output_file
+    ]
+
+
+class ConversionInterrupted(Exception):
+    pass
+
+
+class ProcessSupervisor:
+    """Tracks running ffmpeg children, so an interrupt stops all of them 
+    instead of leaving them running behind the worker threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.stop_event = threading.Event()
+
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+
+    def run(self, command):
+        """Run command to completion unless stopped.
+
+        Returns:
+            tuple: (returncode, stdout, stderr)
+        """
+        with Profiler.command(command):
+            # Check and register under one lock, stop() either sees the
+            # child or we see stopped, never neither
+            with self.lock:
+                if self.stopped:
+                    raise ConversionInterrupted("Conversion interrupted")
+                process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+                self.processes.add(process)
+            try:
+                stdout, stderr = process.communicate()
+            finally:
+                with self.lock:
+                    self.processes.discard(process)
+        if self.stopped:
+            raise ConversionInterrupted("Conversion interrupted")
+        return process.returncode, stdout, stderr
+
+
+    def stop(self, sig=signal.SIGTERM):
+        """Forward sig to every child, kill them if already stopping."""
+        force = self.stopped
+        self.stop_event.set()
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            Logger.debug(f"Stopping ffmpeg, PID: {process.pid}")
+            try:
+                if force:
+                    process.kill()
+                elif os.name == 'nt':
+                    process.terminate()
+                else:
+                    process.send_signal(sig)
+            except ProcessLookupError:
+                pass
+
+
+    def signal_handler(self, sig, frame):
+        Logger.error(f"Interrupt received, stopping {len(self.processes)} " \
+                     + "ffmpeg process(es)...", do_inspect=False)
+        self.stop(sig)
+
+
+supervisor = ProcessSupervisor()
+
+
+def discard_partial_output(partial_file, quarantine_folder=''):
+    """Remove unfinished output, or move it to quarantine_folder."""
+    if not os.path.exists(partial_file):
+        return
+    if quarantine_folder:
+        os.makedirs(quarantine_folder, exist_ok=True)
+        shutil.move(partial_file, os.path.join(quarantine_folder, 
+                                               os.path.basename(partial_file)))
+        Logger.warning(f"Partial output quarantined: {partial_file}")
+    else:
+        os.remove(partial_file)
+        Logger.warning(f"Partial output removed: {partial_file}")
+
+
+def run_ffmpeg(ffmpeg_command, dry_run=False):
+    """Run ffmpeg and log its output.
+
+    Args:
+        ffmpeg_command (list): Command to run
+        dry_run (bool): Only log the command
+
+    Returns:
+        int: Process return code
+    """
+    ffmpeg_command = [arg for arg in ffmpeg_command if arg]
+    Logger.debug(f"ffmpeg_command: {ffmpeg_command}")
+    if dry_run:
+        Logger.info(f"Dry run: {shlex.join(ffmpeg_command)}")
+        return 0
+    returncode, stdout, stderr = supervisor.run(ffmpeg_command)
+    if stdout:
+        Logger.info(stdout.decode())
+    if stderr:
+        Logger.info(stderr.decode())
+    if returncode != 0:
+        Logger.error('Process returned: ' + str(returncode))
+    return returncode
+
+
+@Profiler.wrap
+def encode_sample(filename, offset, seconds, codec, scale=None, fps=None, 
+                  crf=None):
+    """Test-encode one segment at constant quality.
 
+    Returns:
+        int: Bitrate the segment needed, bits per second
+    """
+    fd, sample_file = tempfile.mkstemp(suffix='.mkv')
+    os.close(fd)
+    try:
+        returncode = run_ffmpeg([
+            FFMPEG_PATH,
+            '-hide_banner',
+            '-loglevel', 'error',
+            '-y',
+            '-ss', str(offset),
+            '-t', str(seconds),
+            "-i", filename,
+            "-c:v", codec,
+            *(["-vf", f"scale={scale}"] if scale else []),
+            *(["-r", str(fps)] if fps else []),
+            *get_rate_control_args('crf', codec, None, crf),
+            '-an',
+            sample_file
+        ])
+        if returncode != 0:
+            raise RuntimeError(f"Sample encode failed at {offset:.1f}s")
+        # Shorter than asked for if it hit the end of the title. Uncached,
+        # the temp file is gone right after
+        sample_seconds = get_video_info.__wrapped__(sample_file)['duration']
+        return int(os.path.getsize(sample_file) * 8 / (sample_seconds or seconds))
+    finally:
+        os.remove(sample_file)
+
+
+auto_bitrate_cache_lock = threading.Lock()
+
+def load_auto_bitrate_cache(cache_file):
+    """Read the auto bitrate cache, empty if missing or unreadable."""
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        # A corrupt cache only costs the test encodes again
+        Logger.warning(f"Ignoring auto bitrate cache '{cache_file}': {e}")
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+@Profiler.wrap
+def get_auto_bitrate(filename, codec, scale=None, fps=None, crf=None,
+                     samples=AUTO_BITRATE_SAMPLES, 
+                     seconds=AUTO_BITRATE_SECONDS,
+                     cache_file=AUTO_BITRATE_CACHE_FILE):
+    """Pick a bitrate for the title from constant-quality test encodes of a 
+    few segments, run in parallel. The most complex segment decides, capped by
+    the source bitrate. Results are cached per source and settings.
+
+    Args:
+        crf (int): Target quality of the test encodes
+
+    Returns:
+        int: Bitrate, bits per second
+    """
+    stat = os.stat(filename)
+    key = f"{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}" \
+        + f"|{codec}|{scale}|{fps}|{crf}|{samples}|{seconds}"
+    with auto_bitrate_cache_lock:
+        cache = load_auto_bitrate_cache(cache_file)
+        if key in cache:
+            Logger.debug(f"Auto bitrate from cache: {cache[key]}")
+            return cache[key]
+
+    info = get_video_info(filename)
+    duration = info['duration']
+    seconds = min(seconds, duration) if duration > 0 else seconds
+    # Evenly spaced segments, skipping the very start and end. Without a 
+    # duration only the start can be sampled, once
+    offsets = [duration * (i + 1) / (samples + 1) - seconds / 2 
+               for i in range(samples)] if duration > 0 else [0]
+    offsets = sorted({round(max(0, offset), 3) for offset in offsets})
+    Logger.info(f"Sampling {len(offsets)}x{seconds}s for auto bitrate: " \
+                + filename)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(offsets)) \
+            as executor:
+        bitrates = list(executor.map(
+            lambda offset: encode_sample(filename, offset, seconds, codec, 
+                                         scale, fps, crf), offsets))
+    Logger.debug(f"Sample bitrates: {bitrates}")
+
+    bitrate = max(bitrates)
+    source_bitrate = info['bit_rate'] or info['format_bit_rate']
+    if source_bitrate:
+        bitrate = min(bitrate, source_bitrate)
+
+    with auto_bitrate_cache_lock:
+        if cache_file:
+            cache_dir = os.path.dirname(cache_file) or '.'
+            os.makedirs(cache_dir, exist_ok=True)
+            cache = load_auto_bitrate_cache(cache_file)
+            cache[key] = bitrate
+            # Unique temporary name, concurrent runs don't clobber each other
+            with tempfile.NamedTemporaryFile('w', dir=cache_dir, 
+                                             suffix='.tmp', 
+                                             delete=False) as f:
+                json.dump(cache, f, indent=2)
+            os.replace(f.name, cache_file)
+    return bitrate
+
+
+def get_output_file(filename, output_folder, output_format):
+    """Get output path: 'name.<format>' in output_folder, or output_folder 
+    itself if it is not a folder."""
+    base_name = os.path.splitext(os.path.basename(filename))[0]
     if '.' in output_format:
         output_format = output_format.split('.')[-1]
-
     if os.path.isdir(output_folder):
-        output_file = f"{os.path.join(output_folder, base_name)}.{output_format}"
-    else:
-        output_file = output_folder
+        return f"{os.path.join(output_folder, base_name)}.{output_format}"
+    return output_folder
+
+
+# Function to convert AVI to MP4
+@Profiler.wrap
+def convert(filename, output_folder, output_format, codec, bitrate, 
+            audio_codec, scale=None, fps=None, rewrite=False,
+            rate_control='bitrate', crf=None, maxrate=None, bufsize=None,
+            pass_cache=PASS_CACHE_DIR, pipeline='auto', dry_run=False,
+            auto_bitrate=False, auto_bitrate_cache=AUTO_BITRATE_CACHE_FILE,
+            quarantine_folder=''):
+    if supervisor.stopped:
+        raise ConversionInterrupted("Conversion interrupted")
+    output_file = get_output_file(filename, output_folder, output_format)
     Logger.debug(f"Filename: {filename}")
-    Logger.debug(f"Base name: {base_name}")
     Logger.debug(f"Output folder: {output_folder}")
     Logger.debug(f"Output file: {output_file}")
 
+    if os.path.exists(output_file) and not rewrite:
+        Logger.warning(f"Output file exists, skipping: {output_file}")
+        return
+    # Encode to a hidden temp name, the output only appears when finished
+    output_root, output_ext = os.path.splitext(os.path.basename(output_file))
+    partial_file = os.path.join(os.path.dirname(output_file), 
+                                f".{output_root}.part{output_ext}")
+
     # Get the last modified time of the original file
     last_modified_time = os.path.getmtime(filename)
 
-    if not bitrate:
+    # CRF needs no bitrate, capped CRF only when no maxrate is given
+    need_bitrate = rate_control in ('bitrate', '2pass') \
+        or (rate_control == 'capped-crf' and not maxrate)
+    if not bitrate and need_bitrate and auto_bitrate and not dry_run:
+        bitrate = get_auto_bitrate(filename, codec, scale, fps, crf, 
+                                   cache_file=auto_bitrate_cache)
+        Logger.info(f"Auto bitrate: {bitrate}")
+    elif not bitrate and need_bitrate:
+        if auto_bitrate:
+            # Test encodes are real encodes
+            Logger.info("Dry run: no auto bitrate test encodes, using the " \
+                        + "source bitrate")
         # Get the bitrate of the original file
         bitrate = get_video_bitrate(filename)
-        # bitrate = subprocess.run([
-        #     FFMPEG_PATH,
-        #     "-i", filename,
-        #     "-f", "null",
-        #     "-"
-        # ], stderr=subprocess.PIPE)
-        # bitrate = bitrate.stderr.decode()
-        # bitrate = bitrate[bitrate.find("bitrate"):].split()[1]
-        # bitrate += "k"
         Logger.debug(f"Bitrate: {bitrate}")
 
     if not audio_codec:
@@ -335,45 +976,442 @@ def convert(filename, output_folder, output_format, codec, bitrate,
     if 'nvenc' in codec:
         nvenc = True
 
-    # Run the ffmpeg command
-    ffmpeg_command = [
+    rate_control_args = get_rate_control_args(
+        rate_control, codec, bitrate, crf, maxrate, bufsize)
+    Logger.debug(f"Rate control: {rate_control} {rate_control_args}")
+
+    pass_args = []
+    # NVENC runs both passes in one encode, see get_rate_control_args()
+    if rate_control == '2pass' and not nvenc:
+        prefix = get_pass_log_prefix(filename, codec, scale, fps, pass_cache)
+        pass_log_files = get_pass_log_files(prefix, codec)
+        if all(os.path.exists(f) for f in pass_log_files):
+            Logger.info(f"Reusing first-pass stats: {prefix}")
+        else:
+            Logger.info(f"Running first pass: {filename}")
+            returncode = run_ffmpeg([
+                FFMPEG_PATH,
+                '-hide_banner',
+                '-loglevel', *(['error'] if LOG_LEVEL < 5 else ['info']),
+                '-stats',
+                '-y',
+                "-i", filename,
+                "-c:v", codec,
+                *(["-vf", f"scale={scale}"] if scale else []),
+                *(["-r", str(fps)] if fps else []),
+                *rate_control_args,
+                *get_pass_args(codec, 1, prefix),
+                '-an',
+                '-f', 'null',
+                os.devnull
+            ], dry_run)
+            if returncode != 0:
+                # Do not let a broken first pass into the cache
+                for f in pass_log_files:
+                    if os.path.exists(f):
+                        os.remove(f)
+                raise RuntimeError(f"First pass returned: {returncode}")
+        pass_args = get_pass_args(codec, 2, prefix)
+
+    # Keep frames on the device only when NVENC encodes them
+    hw_scale_filter = HW_SCALE_FILTERS[0]
+    if pipeline == 'auto':
+        hw_scale_filter = get_hw_scale_filter()
+        pipeline = 'gpu' if nvenc and (hw_scale_filter or not scale) \
+            else 'cpu'
+    Logger.debug(f"Pipeline: {pipeline}")
+
+    command_args = dict(scale=scale, fps=fps, rewrite=True,
+                        rate_control_args=rate_control_args, 
+                        pass_args=pass_args)
+    try:
+        # Run the ffmpeg command
+        ffmpeg_command = build_ffmpeg_command(
+            filename, partial_file, codec, audio_codec, pipeline=pipeline,
+            hw_scale_filter=hw_scale_filter, **command_args)
+        returncode = run_ffmpeg(ffmpeg_command, dry_run)
+        if returncode != 0 and pipeline == 'gpu':
+            Logger.warning(f"GPU pipeline failed, retrying on CPU: {filename}")
+            ffmpeg_command = build_ffmpeg_command(
+                filename, partial_file, codec, audio_codec, pipeline='cpu',
+                **command_args)
+            returncode = run_ffmpeg(ffmpeg_command, dry_run)
+        if returncode != 0:
+            raise RuntimeError(f"Process returned: {returncode}")
+    except BaseException:
+        discard_partial_output(partial_file, quarantine_folder)
+        raise
+    if dry_run:
+        return
+    os.replace(partial_file, output_file)
+
+    # Set the last modified time of the new file to match the original file
+    os.utime(output_file, (last_modified_time, last_modified_time))
+
+
+
+def run_benchmark_encode(ffmpeg_command):
+    """Run one benchmark encode and collect its resource usage.
+
+    Returns:
+        dict: 'cpu' seconds (user + sys) and 'peak_rss' bytes, None where the
+            platform can not tell (no os.wait4 on Windows)
+    """
+    with tempfile.TemporaryFile() as stderr, \
+            Profiler.command(ffmpeg_command):
+        process = subprocess.Popen(ffmpeg_command, stdout=subprocess.DEVNULL,
+                                   stderr=stderr)
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            cpu = rusage.ru_utime + rusage.ru_stime
+            # ru_maxrss is in KB on Linux, in bytes on macOS
+            peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' 
+                                           else 1024)
+        else:
+            process.wait()
+            cpu = peak_rss = None
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"ffmpeg returned {process.returncode}: " \
+                + stderr.read().decode(errors='replace').strip())
+    return {'cpu': cpu, 'peak_rss': peak_rss}
+
+
+@Profiler.wrap
+def run_benchmark_case(codec, resolution, fps, jobs, work_dir, duration=10, 
+                       bitrate='4M', source_resolution='1920x1080', 
+                       source_fps=30):
+    """Encode the synthetic source with `jobs` ffmpeg processes at once.
+
+    Returns:
+        dict: 'wall', 'fps' (frames of all jobs per wall second), 'cpu' 
+            (utilization, 1.0 = one core), 'size' (mean output bytes), 
+            'peak_rss' (largest single ffmpeg)
+    """
+    source_fps = fps or source_fps
+    video_source = BENCHMARK_VIDEO_SOURCE.format(
+        resolution=source_resolution, fps=source_fps, duration=duration)
+    audio_source = BENCHMARK_AUDIO_SOURCE.format(duration=duration)
+    output_files = [os.path.join(work_dir, f"job{i}.mp4") for i in range(jobs)]
+    commands = [[
         FFMPEG_PATH,
         '-hide_banner',
-        '-loglevel', *(['error'] if LOG_LEVEL < 5 else ['info']),
-        '-stats',
-        '-y' if rewrite else '-n',
-        '-hwaccel', 'cuda' if nvenc else 'auto',
-        "-i", filename,
+        '-loglevel', 'error',
+        '-y',
+        '-f', 'lavfi', '-i', video_source,
+        '-f', 'lavfi', '-i', audio_source,
         "-c:v", codec,
-        *(["-vf", f"scale={scale}"] if scale else []),
-        *(["-r", str(fps)] if fps else []),
-        "-b:v", str(bitrate),
-        "-c:a", audio_codec,
-        '-strict', 'experimental',
-        "-map_metadata", "0",
+        *(["-vf", f"scale={resolution.replace('x', ':')}"] if resolution else []),
+        *get_rate_control_args('bitrate', codec, bitrate),
+        "-c:a", 'aac',
+        '-shortest',
         output_file
-    ]
-    ffmpeg_command = [arg for arg in ffmpeg_command if arg]
-    Logger.debug(f"ffmpeg_command: {ffmpeg_command}")
-    result = subprocess.run(ffmpeg_command, stdout=subprocess.PIPE, 
-                              stderr=subprocess.PIPE)
-    if result.stdout:
-        Logger.info(result.stdout.decode())
-    if result.stderr:
-        Logger.info(result.stderr.decode())
-    if result.returncode != 0:
-        Logger.error('Process returned: ' + str(result.returncode))
-        exit(result.returncode)
+    ] for output_file in output_files]
 
-    # Set the last modified time of the new file to match the original file
-    os.utime(output_file, (last_modified_time, last_modified_time))
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        usages = list(executor.map(run_benchmark_encode, commands))
+    wall = time.perf_counter() - start
 
+    cpus = [usage['cpu'] for usage in usages]
+    rss = [usage['peak_rss'] for usage in usages]
+    return {
+        'wall': wall,
+        'fps': duration * source_fps * jobs / wall,
+        'cpu': sum(cpus) / wall if None not in cpus else None,
+        'size': statistics.mean(os.path.getsize(f) for f in output_files),
+        'peak_rss': max(rss) if None not in rss else None,
+    }
 
 
-def main():
+def summarize_benchmark_runs(runs):
+    """Mean and standard deviation of every metric over repeat runs."""
+    summary = {}
+    for metric in runs[0]:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        summary[f"{metric}_mean"] = statistics.mean(values) if values else None
+        summary[f"{metric}_stdev"] = statistics.stdev(values) \
+            if len(values) > 1 else 0.0 if values else None
+    return summary
+
+
+def benchmark(codecs, resolutions, fps_list, jobs_list, repeat=3, duration=10,
+              bitrate='4M', source_resolution='1920x1080', source_fps=30,
+              report_file=''):
+    """Run every codec/resolution/fps/jobs combination `repeat` times on 
+    synthetic lavfi sources and report the results.
+
+    Args:
+        report_file (str): '.csv' or '.json' report, none if empty
+
+    Returns:
+        list: One dict per combination
+    """
+    results = []
+    matrix = list(itertools.product(codecs, resolutions, fps_list, jobs_list))
+    with tempfile.TemporaryDirectory() as work_dir:
+        for i, (codec, resolution, fps, jobs) in enumerate(matrix):
+            case = {'codec': codec, 'resolution': resolution or 'source', 
+                    'fps': fps or source_fps, 'jobs': jobs}
+            Logger.info(f"[{i + 1}/{len(matrix)}] {case}")
+            try:
+                runs = [run_benchmark_case(
+                    codec, resolution, fps, jobs, work_dir, duration, bitrate,
+                    source_resolution, source_fps) for _ in range(repeat)]
+            except Exception as e:
+                Logger.error(f"Benchmark failed: {case}: {e}")
+                continue
+            case.update(summarize_benchmark_runs(runs))
+            case['runs'] = repeat
+            results.append(case)
+
+    Logger.info(f"{'codec':<12} {'res':>9} {'fps':>4} {'j':>2} " \
+                + f"{'enc fps':>14} {'wall s':>13} {'cpu %':>6} " \
+                + f"{'size MB':>8} {'rss MB':>7}")
+    for r in results:
+        cpu = f"{r['cpu_mean'] * 100:6.0f}" if r['cpu_mean'] is not None \
+            else f"{'-':>6}"
+        rss = f"{r['peak_rss_mean'] / 1024 ** 2:7.0f}" \
+            if r['peak_rss_mean'] is not None else f"{'-':>7}"
+        Logger.info(f"{r['codec']:<12} {r['resolution']:>9} {r['fps']:>4} " \
+                    + f"{r['jobs']:>2} " \
+                    + f"{r['fps_mean']:7.1f}±{r['fps_stdev']:<6.1f} " \
+                    + f"{r['wall_mean']:6.2f}±{r['wall_stdev']:<6.2f} {cpu} " \
+                    + f"{r['size_mean'] / 1024 ** 2:8.2f} {rss}")
+
+    if report_file and results:
+        os.makedirs(os.path.dirname(report_file) or '.', exist_ok=True)
+        if report_file.lower().endswith('.csv'):
+            with open(report_file, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=results[0].keys())
+                writer.writeheader()
+                writer.writerows(results)
+        else:
+            with open(report_file, 'w') as f:
+                json.dump(results, f, indent=2)
+        Logger.happy(f"Benchmark report: {report_file}")
+    return results
+
+
+def benchmark_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='encode-video.py benchmark',
+        description='Benchmark encoder settings on synthetic lavfi sources ' \
+            + '(testsrc2/sine).')
+    parser.add_argument(
+        "--codecs", type=str, default="libx264,libx265",
+        help="Comma-separated video codecs. Default: 'libx264,libx265'.")
+    parser.add_argument(
+        "--resolutions", type=str, default="1280x720,1920x1080",
+        help="Comma-separated output resolutions, 'source' to keep the " \
+            + "source resolution. Default: '1280x720,1920x1080'.")
+    parser.add_argument(
+        "--fps", type=str, default="30",
+        help="Comma-separated frames per second. Default: '30'.")
+    parser.add_argument(
+        "-j", "--jobs", type=str, default="1",
+        help="Comma-separated numbers of parallel encodes. Default: '1'.")
+    parser.add_argument(
+        "--bitrate", type=str, default="4M",
+        help="Bitrate for the encodes. Default: '4M'.")
+    parser.add_argument(
+        "--duration", type=int, default=10,
+        help="Source duration in seconds. Default: 10.")
+    parser.add_argument(
+        "--source-resolution", type=str, default="1920x1080",
+        help="Source resolution. Default: '1920x1080'.")
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="Runs per combination. Default: 3.")
+    parser.add_argument(
+        "--report", type=str, default="",
+        help="Report file, '.csv' or '.json'.")
+    parser.add_argument(
+        "--profile", type=str, default="",
+        help="Write a Chrome trace-event JSON of the benchmark encodes " \
+            + "to this file. Default: off.")
+    args = parser.parse_args(argv)
+    if args.profile:
+        Profiler.enable(args.profile)
+
+    def split(value):
+        return [v.strip() for v in value.split(',') if v.strip()]
+    benchmark(
+        split(args.codecs),
+        ['' if r == 'source' else r for r in split(args.resolutions)],
+        [int(fps) for fps in split(args.fps)],
+        [int(jobs) for jobs in split(args.jobs)],
+        repeat=args.repeat, duration=args.duration, bitrate=args.bitrate,
+        source_resolution=args.source_resolution, report_file=args.report)
+
+
+# inotify(7) event flags
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def open_inotify(folder):
+    """Watch folder for files closed after writing or moved in.
+
+    Args:
+        folder (str): Folder to watch, not recursive
+
+    Returns:
+        int: inotify file descriptor, None if inotify is not available
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(folder), 
+                              IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def read_inotify_events(fd, timeout):
+    """Wait up to timeout seconds for inotify events.
+
+    Returns:
+        tuple: (file names, True if the kernel queue overflowed and events
+            were lost)
+    """
+    ready, _, _ = select.select([fd], [], [], timeout)
+    if not ready:
+        return [], False
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return [], False
+    names, overflow, offset = [], False, 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        overflow = overflow or bool(mask & IN_Q_OVERFLOW)
+        if name:
+            names.append(os.fsdecode(name))
+    return names, overflow
+
+
+def get_file_version(folder, name):
+    """Get (size, mtime) of a visible regular file, None for anything else,
+    e.g. hidden partial outputs."""
+    if name.startswith('.'):
+        return None
+    try:
+        stat = os.stat(os.path.join(folder, name))
+    except OSError:
+        return None
+    if not os.path.isfile(os.path.join(folder, name)):
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def watch_folder(folder, callback, extension='', watcher='auto', 
+                 settle=WATCH_SETTLE_SECONDS, interval=WATCH_POLL_INTERVAL,
+                 ignore=None):
+    """Call callback(name, changed) once for every finished file in folder 
+    until the conversion is stopped. A file is finished when it is closed 
+    after writing or moved in (inotify), or when its size and mtime did not 
+    change for settle seconds (polling, and files already there on start). 
+    A file that changes after that is reported again with changed True.
+
+    Args:
+        folder (str): Folder to watch, not recursive
+        callback (callable): Called with the file name and whether an 
+            earlier version of it was reported
+        extension (str): Only files with this extension, e.g. 'avi', all 
+            if empty
+        watcher (str): One of WATCHERS
+        settle (float): Seconds without changes for polling
+        interval (float): Seconds between polls
+        ignore (set): Names never reported, e.g. outputs written into the
+            folder; callback may add to it
+    """
+    fd = open_inotify(folder) if watcher != 'poll' else None
+    if watcher == 'inotify' and fd is None:
+        raise RuntimeError("inotify is not available")
+    Logger.info(f"Watching \"{folder}\" " \
+        + ("for close-write/move-in events" if fd is not None 
+           else f"for files unchanged for {settle}s"))
+    suffix = f".{extension.lower()}" if extension else ''
+    ignore = set() if ignore is None else ignore
+    reported = {}  # name -> version passed to callback
+    pending = {}  # name -> (version, seconds since it is unchanged)
+
+    def scan():
+        for entry in os.scandir(folder):
+            if not entry.name.lower().endswith(suffix) \
+                or entry.name in ignore:
+                continue
+            version = get_file_version(folder, entry.name)
+            if version and reported.get(entry.name) != version \
+                and entry.name not in pending:
+                pending[entry.name] = (version, time.monotonic())
+
+    def report(name, version):
+        pending.pop(name, None)
+        if name in ignore:
+            return
+        if version and reported.get(name) != version:
+            changed = name in reported
+            reported[name] = version
+            Logger.info(f"{'Changed' if changed else 'New'} file: {name}")
+            callback(name, changed)
+
+    # Files already there may still be written, so they settle first
+    scan()
+    try:
+        while not supervisor.stopped:
+            if fd is None:
+                scan()
+            for name, (version, since) in list(pending.items()):
+                current = get_file_version(folder, name)
+                if current != version:
+                    if current:
+                        pending[name] = (current, time.monotonic())
+                    else:
+                        del pending[name]
+                elif time.monotonic() - since >= settle:
+                    report(name, version)
+            if fd is None:
+                supervisor.stop_event.wait(interval)
+                continue
+            names, overflow = read_inotify_events(fd, interval)
+            for name in names:
+                if not name.lower().endswith(suffix):
+                    continue
+                report(name, get_file_version(folder, name))
+            if overflow:
+                Logger.warning("inotify queue overflowed, rescanning")
+                scan()
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['benchmark']:
+        benchmark_main(argv[1:])
+        return
 # Loop through all .avi files in the current directory
     parser = argparse.ArgumentParser(
-        description='Convert video files to a different format using ffmpeg.')
+        description='Convert video files to a different format using ffmpeg.',
+        epilog="Run 'encode-video.py benchmark -h' to benchmark encoder settings.")
 
     parser.add_argument(
         "input_path", type=str, 
@@ -394,6 +1432,35 @@ def main():
     parser.add_argument(
         "--bitrate", type=str, default="",
         help="Bitrate for the output files (e.g., '192k', '2M').")
+    parser.add_argument(
+        "--auto-bitrate", action='store_true',
+        help="If --bitrate is empty, pick it from constant-quality (--crf) " \
+            + f"test encodes of {AUTO_BITRATE_SAMPLES}x{AUTO_BITRATE_SECONDS}s " \
+            + "segments instead of copying the source bitrate.")
+    parser.add_argument(
+        "--auto-bitrate-cache", type=str, default=AUTO_BITRATE_CACHE_FILE,
+        help="Cache file for auto bitrates. " \
+            + f"Default: '{AUTO_BITRATE_CACHE_FILE}'.")
+    parser.add_argument(
+        "--rate-control", type=str, default="bitrate", 
+        choices=RATE_CONTROL_PROFILES.keys(),
+        help="Rate-control profile: " + ", ".join(
+            f"'{k}' - {v}" for k, v in RATE_CONTROL_PROFILES.items()) \
+            + ". Default: 'bitrate'.")
+    parser.add_argument(
+        "--crf", type=int, default=None,
+        help="Quality for 'crf' and 'capped-crf' (-cq for NVENC). " \
+            + f"Default: {DEFAULT_CRF}.")
+    parser.add_argument(
+        "--maxrate", type=str, default="",
+        help="Max bitrate for 'capped-crf' (e.g., '4M'). Default: --bitrate.")
+    parser.add_argument(
+        "--bufsize", type=str, default="",
+        help="VBV buffer size for 'capped-crf' (e.g., '8M'). " \
+            + "Default: 2x --maxrate.")
+    parser.add_argument(
+        "--pass-cache", type=str, default=PASS_CACHE_DIR,
+        help=f"Folder for cached first-pass stats. Default: '{PASS_CACHE_DIR}'.")
     parser.add_argument(
         "--audio-codec", type=str, default="aac",
         help="Audio codec for the output files (e.g., 'aac').")
@@ -410,14 +1477,58 @@ def main():
     parser.add_argument(
         "--fps", type=int, default=None,
         help="Frames per second for the output files (e.g., 30).")
+    parser.add_argument(
+        "--pipeline", type=str, default="auto", choices=PIPELINES,
+        help="'gpu' keeps frames on the device from decode to NVENC " \
+            + f"(-hwaccel_output_format cuda, {'/'.join(HW_SCALE_FILTERS)}), " \
+            + "'cpu' scales on the host, 'auto' uses 'gpu' for NVENC codecs " \
+            + "when ffmpeg has a hardware scale filter. A failed 'gpu' " \
+            + "encode is retried on 'cpu'. Default: 'auto'.")
+    parser.add_argument(
+        "--dry-run", action='store_true', 
+        help="Print ffmpeg commands without running them.")
+    parser.add_argument(
+        "--quarantine-folder", type=str, default="",
+        help="Move unfinished outputs here on failure or interrupt instead " \
+            + "of deleting them.")
     parser.add_argument(
         "--rewrite", action='store_true', 
         help="Rewrite the output file if it already exists.")
     parser.add_argument(
         "-j", "--jobs", type=int, default=1,
         help="Number of jobs to run in parallel. Default is 1.")
+    parser.add_argument(
+        "--watch", action='store_true',
+        help="Keep watching the input folder and convert each new file " \
+            + "once it is finished, until Ctrl-C. Files already in the " \
+            + "folder are converted once unchanged for --watch-settle seconds.")
+    parser.add_argument(
+        "--watcher", type=str, default="auto", choices=WATCHERS,
+        help="'inotify' converts a file when it is closed after writing or " \
+            + "moved in (Linux), 'poll' when its size and mtime did not " \
+            + "change for --watch-settle seconds, 'auto' uses 'inotify' if " \
+            + "available. Default: 'auto'.")
+    parser.add_argument(
+        "--watch-settle", type=float, default=WATCH_SETTLE_SECONDS,
+        help="Seconds without size/mtime changes for a file to count as " \
+            + f"finished when polling. Default: {WATCH_SETTLE_SECONDS}.")
+    parser.add_argument(
+        "--profile", type=str, default="",
+        help="Write a Chrome trace-event JSON of phases and " \
+            + "ffmpeg/ffprobe runs to this file. Default: off.")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.profile:
+        Profiler.enable(args.profile)
+    if args.watch and not os.path.isdir(args.input_path):
+        parser.error("--watch needs a folder as input_path")
+    if args.rate_control == '2pass' and get_codec_family(args.codec) == 'other':
+        parser.error(f"--rate-control 2pass needs an x264, x265 or NVENC " \
+                     + f"codec, got '{args.codec}'")
+
+    # Stop ffmpeg children and clean up partial outputs on Ctrl-C/kill
+    signal.signal(signal.SIGINT, supervisor.signal_handler)
+    signal.signal(signal.SIGTERM, supervisor.signal_handler)
 
     LOG_LEVEL = LOG_LEVELS[args.log_level]
     args.resolution = args.resolution.replace('_', '-')
@@ -430,6 +1541,7 @@ def main():
     Logger.debug(f"FPS: {args.fps}")
     Logger.debug(f"Codec: {args.codec}")
     Logger.debug(f"Bitrate: {args.bitrate}")
+    Logger.debug(f"Rate control: {args.rate_control}")
     Logger.debug(f"Audio codec: {args.audio_codec}")
 
     import concurrent.futures
@@ -458,7 +1570,17 @@ def main():
                 scale=args.resolution.replace('x', ':') \
                     if args.resolution else None,
                 fps=args.fps,
-                rewrite=args.rewrite)
+                rewrite=args.rewrite,
+                rate_control=args.rate_control,
+                crf=args.crf,
+                maxrate=args.maxrate,
+                bufsize=args.bufsize,
+                pass_cache=args.pass_cache,
+                pipeline=args.pipeline,
+                dry_run=args.dry_run,
+                auto_bitrate=args.auto_bitrate,
+                auto_bitrate_cache=args.auto_bitrate_cache,
+                quarantine_folder=args.quarantine_folder)
     else:
         if not args.log_file:
             LOG_FILE = args.log_file = os.path.join(
@@ -466,8 +1588,11 @@ def main():
         else:
             LOG_FILE = args.log_file
         
-        def convert_file(file, args):
+        def convert_file(file, args, rewrite=False, previous=None):
             try:
+                if previous:
+                    # An older version of the file is still converting
+                    concurrent.futures.wait([previous])
                 if (file.lower().endswith(f".{args.input_format}") \
                     and os.path.isfile(os.path.join(args.input_path, file))) \
                     or not args.input_format:
@@ -481,25 +1606,62 @@ def main():
                         scale=args.resolution.replace('x', ':') \
                             if args.resolution else None,
                         fps=args.fps,
-                        rewrite=args.rewrite)
+                        rewrite=args.rewrite or rewrite,
+                        rate_control=args.rate_control,
+                        crf=args.crf,
+                        maxrate=args.maxrate,
+                        bufsize=args.bufsize,
+                        pass_cache=args.pass_cache,
+                        pipeline=args.pipeline,
+                        dry_run=args.dry_run,
+                        auto_bitrate=args.auto_bitrate,
+                        auto_bitrate_cache=args.auto_bitrate_cache,
+                        quarantine_folder=args.quarantine_folder)
                 Logger.debug(f"Thread finished: {file}")
+            except ConversionInterrupted:
+                Logger.debug(f"Thread interrupted: {file}")
             except Exception as e:
                 Logger.error(f"Error converting {file}: {e}")
-            except KeyboardInterrupt:
-                Logger.error(f"Conversion interrupted.")
-                exit(1)
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=int(args.jobs)) as executor:
-            futures = []
-            for file in os.listdir(args.input_path):
-                # if file is folder
-                if not os.path.isfile(os.path.join(args.input_path, file)):
-                    continue
-                futures.append(executor.submit(convert_file, file, args))
-            
-            # Wait for all futures to complete
-            concurrent.futures.wait(futures)
+            if args.watch:
+                # Only finished files are queued, the executor waits for 
+                # the running conversions on exit
+                watch_futures, outputs = {}, set()
+
+                def submit(file, changed):
+                    # Outputs landing in the watched folder are not inputs
+                    output_file = get_output_file(
+                        os.path.join(args.input_path, file), 
+                        args.output_folder, args.output_format)
+                    if os.path.dirname(os.path.realpath(output_file)) \
+                            == os.path.realpath(args.input_path):
+                        outputs.add(os.path.basename(output_file))
+                    # A changed source is converted again, over the output
+                    # of its earlier version, e.g. an upload that paused
+                    previous = watch_futures.get(file)
+                    if previous:
+                        previous.cancel()
+                    watch_futures[file] = executor.submit(
+                        convert_file, file, args, changed, previous)
+
+                watch_folder(
+                    args.input_path, submit, args.input_format or '', 
+                    args.watcher, args.watch_settle, ignore=outputs)
+            else:
+                futures = []
+                for file in os.listdir(args.input_path):
+                    # if file is folder
+                    if not os.path.isfile(os.path.join(args.input_path, file)):
+                        continue
+                    futures.append(executor.submit(convert_file, file, args))
+                
+                # Wait for all futures to complete
+                concurrent.futures.wait(futures)
 
+        if supervisor.stopped:
+            Logger.error(f"Conversion interrupted.")
+            exit(1)
             
     Logger.happy("Conversion complete!")
 
@@ -1,42 +1,479 @@
 import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import fnmatch
+import argparse
+import datetime
+import tempfile
+import functools
+import threading
+import contextlib
 import subprocess
+import concurrent.futures
 
-# Directory where ffmpeg.exe is located
-FFMPEG_PATH = r"ffmpeg.exe"
+# ffmpeg executable, ffprobe is expected next to it
+FFMPEG_PATH = "ffmpeg"
 
-# Function to glue MP4 files
-def glue_mp4_files():
-    # Get all MP4 files in the current directory
-    mp4_files = [file for file in os.listdir(".") if file.lower().endswith(".mp4")]
+SORT_KEYS = ["ctime", "mtime", "name", "creation_time"]
+MODES = ["auto", "copy", "reencode"]
+TIMESTAMP_MODES = ["keep", "repair"]
+# Gaps below this (seconds) are left alone
+TIMESTAMP_TOLERANCE = 0.001
 
-    # Sort the MP4 files by their creation datetime
-    mp4_files.sort(key=lambda x: os.path.getctime(x))
-    last_modified_time = os.path.getmtime(mp4_files[0])
+# Stream fields that must match across inputs for concat with -c copy
+VIDEO_COPY_FIELDS = ["codec_name", "profile", "width", "height", "pix_fmt"]
+AUDIO_COPY_FIELDS = ["codec_name", "profile", "sample_rate", "channels"]
 
-    # Create a temporary text file to store the list of MP4 files
-    file_list = "file_list.txt"
-    with open(file_list, "w") as f:
-        for file in mp4_files:
-            f.write(f"file '{file}'\n")
+# ==============================================================================
+# Profiler class
+# v1.1.0
+# ==============================================================================
 
-    # Get the metadata of the first MP4 file
-    first_file = mp4_files[0]
+class Profiler:
+    """Records timing spans of phases and subprocesses and saves them as
+    Chrome trace-event JSON, viewable in chrome://tracing or
+    https://ui.perfetto.dev. Does nothing until enable() is called"""
+    path = None
+    events = []
+    tracks = {}
+    origin = time.perf_counter()
 
-    # Run the ffmpeg command to concatenate the MP4 files
-    ffmpeg_command = [
-        FFMPEG_PATH,
+    @staticmethod
+    def enable(path):
+        """Start recording and save to path on exit
+
+        Args:
+            path (str): Trace file path
+        """
+        Profiler.path = path
+        atexit.register(Profiler.save)
+
+    @staticmethod
+    def get_track():
+        """Get the trace row of the caller: its asyncio task, so concurrent
+        tasks do not overlap on one row, otherwise its thread"""
+        asyncio = sys.modules.get("asyncio")
+        task = None
+        if asyncio:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                pass
+        if task:
+            track, name = id(task), task.get_name()
+        else:
+            thread = threading.current_thread()
+            track, name = thread.ident, thread.name
+        Profiler.tracks[track] = name
+        return track
+
+    @staticmethod
+    def add(name, category, start, end, track, args=None):
+        """Add a complete event, start and end from time.perf_counter()"""
+        Profiler.events.append({
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - Profiler.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": track, "args": args or {},
+        })
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category="phase", **args):
+        """Context manager recording a span around its body
+
+        Args:
+            name (str): Span name
+            category (str): Span category
+            **args: Extra values shown with the span
+        """
+        if Profiler.path is None:
+            yield
+            return
+        track = Profiler.get_track()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Profiler.add(name, category, start, time.perf_counter(), track,
+                         args)
+
+    @staticmethod
+    def wrap(func):
+        """Decorator recording a span named after func for every call"""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def command(command):
+        """Context manager recording a span around running command, named
+        after its executable
+
+        Args:
+            command (list): Command line of the process
+        """
+        return Profiler.span(os.path.basename(str(command[0])), "subprocess",
+                             command=" ".join(map(str, command)))
+
+    @staticmethod
+    def save():
+        """Write the recorded spans to the trace file"""
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                     "tid": track, "args": {"name": name}}
+                    for track, name in Profiler.tracks.items()]
+        directory = os.path.dirname(os.path.abspath(Profiler.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(Profiler.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + Profiler.events,
+                       "displayTimeUnit": "ms"}, f)
+
+# ==============================================================================
+# End of Profiler class
+# ==============================================================================
+
+
+def get_ffprobe_path(ffmpeg_path):
+    """Get ffprobe path next to the ffmpeg executable"""
+    directory, name = os.path.split(ffmpeg_path)
+    return os.path.join(directory, name.replace("ffmpeg", "ffprobe"))
+
+
+@Profiler.wrap
+def find_input_files(input_dir, pattern, exclude=()):
+    """Find files in input_dir whose name matches the glob pattern
+    (case-insensitive), stat'ed once while listing"""
+    exclude = {os.path.abspath(path) for path in exclude}
+    files = []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() \
+                    or not fnmatch.fnmatch(entry.name.lower(), pattern.lower()) \
+                    or os.path.abspath(entry.path) in exclude:
+                continue
+            stat = entry.stat()
+            files.append({
+                "path": entry.path,
+                "name": entry.name,
+                "ctime": stat.st_ctime,
+                "mtime": stat.st_mtime,
+            })
+    return files
+
+
+def probe_file(ffprobe_path, path):
+    """Get streams, duration and creation_time of a file with one ffprobe
+    call"""
+    cmd = [
+        ffprobe_path,
+        "-v", "error",
+        "-print_format", "json",
+        "-show_entries",
+        "stream=index,codec_type,codec_name,profile,width,height,pix_fmt,"
+        "sample_rate,channels,start_time,duration"
+        ":format=start_time,duration:format_tags=creation_time",
+        path,
+    ]
+    with Profiler.command(cmd):
+        result = subprocess.run(cmd, capture_output=True, text=True,
+                                check=True)
+    info = json.loads(result.stdout)
+    fmt = info.get("format", {})
+    return {
+        "streams": info.get("streams", []),
+        "start_time": float(fmt.get("start_time") or 0),
+        "duration": float(fmt.get("duration") or 0),
+        "creation_time": fmt.get("tags", {}).get("creation_time"),
+    }
+
+
+@Profiler.wrap
+def probe_files(ffprobe_path, files, jobs):
+    """Probe files in parallel, adds the probe result to every file.
+    Returns False if any probe failed"""
+    ok = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(probe_file, ffprobe_path, file["path"]): file
+                   for file in files}
+        for future in concurrent.futures.as_completed(futures):
+            file = futures[future]
+            try:
+                file.update(future.result())
+            except (subprocess.SubprocessError, json.JSONDecodeError,
+                    OSError, ValueError) as e:
+                print(f"Error probing {file['path']}: {e}")
+                ok = False
+    return ok
+
+
+def parse_creation_time(value):
+    """Parse ISO 8601 creation_time tag to a timestamp, None if missing"""
+    if not value:
+        return None
+    try:
+        value = value.replace("Z", "+00:00")
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+@Profiler.wrap
+def sort_files(files, sort_key):
+    """Sort files in place. creation_time falls back to mtime for files
+    without the tag"""
+    if sort_key == "creation_time":
+        files.sort(key=lambda file: (
+            parse_creation_time(file.get("creation_time")) or file["mtime"],
+            file["name"]))
+    else:
+        files.sort(key=lambda file: (file[sort_key], file["name"]))
+
+
+def get_copy_signature(file):
+    """Get what has to match across inputs for stream copy"""
+    signature = []
+    for stream in file["streams"]:
+        if stream.get("codec_type") == "video":
+            fields = VIDEO_COPY_FIELDS
+        elif stream.get("codec_type") == "audio":
+            fields = AUDIO_COPY_FIELDS
+        else:
+            continue
+        signature.append((stream["codec_type"],)
+                         + tuple(stream.get(field) for field in fields))
+    return tuple(signature)
+
+
+@Profiler.wrap
+def check_copy_compatible(files):
+    """Check if files can be concatenated with -c copy. Returns a list of
+    mismatch descriptions, empty if compatible"""
+    reference = get_copy_signature(files[0])
+    mismatches = []
+    for file in files[1:]:
+        signature = get_copy_signature(file)
+        if signature != reference:
+            mismatches.append(
+                f"{file['name']}: {signature} != {files[0]['name']}: {reference}")
+    return mismatches
+
+
+def escape_concat_path(path):
+    """Quote path for the concat demuxer list"""
+    return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+
+def get_concat_points(file):
+    """Get (inpoint, outpoint) where every audio/video stream of the file
+    has data, from the probed stream start times and durations. None if
+    the streams don't report them"""
+    starts, ends = [], []
+    for stream in file["streams"]:
+        if stream.get("codec_type") not in ("video", "audio"):
+            continue
+        try:
+            start = float(stream["start_time"])
+            duration = float(stream["duration"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        starts.append(start)
+        ends.append(start + duration)
+    if not starts:
+        return None
+    inpoint, outpoint = max(starts), min(ends)
+    if outpoint <= inpoint:
+        return None
+    return inpoint, outpoint
+
+
+def write_concat_list(f, files, timestamps="keep"):
+    """Write the concat demuxer list. With timestamps="repair" every entry
+    gets a duration directive, and inpoint/outpoint trim the ends where
+    only some streams have data, so the streams stay in sync across files
+    and the output is seekable"""
+    for file in files:
+        f.write(f"file {escape_concat_path(file['path'])}\n")
+        if timestamps != "repair":
+            continue
+        points = get_concat_points(file)
+        if points is None:
+            print(f"Warning: no stream timestamps in {file['name']}, "
+                  "keeping it as is")
+            continue
+        inpoint, outpoint = points
+        file_start = file["start_time"]
+        file_end = file_start + file["duration"]
+        if inpoint - file_start > TIMESTAMP_TOLERANCE \
+                or file_end - outpoint > TIMESTAMP_TOLERANCE:
+            print(f"Trimming {file['name']}: {inpoint - file_start:.3f}s at "
+                  f"the start, {file_end - outpoint:.3f}s at the end")
+        if inpoint - file_start > TIMESTAMP_TOLERANCE:
+            f.write(f"inpoint {inpoint:.6f}\n")
+        if file_end - outpoint > TIMESTAMP_TOLERANCE:
+            f.write(f"outpoint {outpoint:.6f}\n")
+        f.write(f"duration {outpoint - inpoint:.6f}\n")
+
+
+def build_copy_command(ffmpeg_path, list_file, output, timestamps="keep"):
+    """Build ffmpeg command that concatenates with stream copy"""
+    cmd = [
+        ffmpeg_path,
+        "-v", "error", "-nostdin", "-y",
         "-f", "concat",
         "-safe", "0",
-        "-i", file_list,
+        "-i", list_file,
         "-c", "copy",
         "-map_metadata", "0",
-        "output.mp4"
     ]
-    subprocess.run(ffmpeg_command, check=True)
+    if timestamps == "repair":
+        # Start at zero and put the index first for fast seeking
+        cmd += ["-avoid_negative_ts", "make_zero"]
+        if os.path.splitext(output)[1].lower() in (".mp4", ".m4v", ".mov"):
+            cmd += ["-movflags", "+faststart"]
+    return cmd + [output]
+
+
+def build_reencode_command(ffmpeg_path, files, output, encoder, crf):
+    """Build ffmpeg command that re-encodes all inputs to the first input's
+    resolution with the concat filter. Audio is kept only if every input
+    has it"""
+    first_video = next((stream for stream in files[0]["streams"]
+                        if stream.get("codec_type") == "video"), {})
+    width = first_video.get("width", 1920)
+    height = first_video.get("height", 1080)
+    with_audio = all(any(stream.get("codec_type") == "audio"
+                         for stream in file["streams"]) for file in files)
+
+    cmd = [ffmpeg_path, "-v", "error", "-nostdin", "-y"]
+    for file in files:
+        cmd += ["-i", file["path"]]
+    filters = []
+    inputs = ""
+    for i in range(len(files)):
+        filters.append(
+            f"[{i}:v:0]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p[v{i}]")
+        inputs += f"[v{i}]"
+        if with_audio:
+            filters.append(f"[{i}:a:0]aresample=48000[a{i}]")
+            inputs += f"[a{i}]"
+    filters.append(f"{inputs}concat=n={len(files)}:v=1:a={int(with_audio)}"
+                   + ("[v][a]" if with_audio else "[v]"))
+    cmd += ["-filter_complex", ";".join(filters), "-map", "[v]"]
+    if with_audio:
+        cmd += ["-map", "[a]", "-c:a", "aac", "-b:a", "192k"]
+    cmd += ["-c:v", encoder, "-crf", str(crf), "-map_metadata", "0", output]
+    return cmd
+
+
+@Profiler.wrap
+def glue_mp4_files(input_dir=".", pattern="*.mp4", sort_key="ctime",
+                   output=None, mode="auto", jobs=8, ffmpeg_path=FFMPEG_PATH,
+                   encoder="libx264", crf=20, timestamps="keep"):
+    """Concatenate matching files in input_dir into output. Inputs are
+    probed in parallel first, stream copy is used only if they match"""
+    if not os.path.isdir(input_dir):
+        print(f"Not a directory: {input_dir}")
+        return False
+    output = output or os.path.join(input_dir, "output.mp4")
+    files = find_input_files(input_dir, pattern, exclude=[output])
+    if not files:
+        print(f"No files matching {pattern} in {input_dir}")
+        return False
+
+    # Pre-flight: nothing is written until every input is probed
+    if not probe_files(get_ffprobe_path(ffmpeg_path), files, jobs):
+        return False
+    sort_files(files, sort_key)
+    last_modified_time = files[0]["mtime"]
+
+    mismatches = check_copy_compatible(files)
+    if mode == "auto":
+        mode = "reencode" if mismatches else "copy"
+    for mismatch in mismatches:
+        print(f"Incompatible for stream copy: {mismatch}")
+    if mismatches and mode == "copy":
+        print("Warning: forcing stream copy, the output may be broken")
+    print(f"Concatenating {len(files)} file(s) into {output} ({mode})")
+
+    if mode == "copy":
+        # Create a temporary text file to store the list of MP4 files
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False,
+                                         encoding="utf-8") as f:
+            list_file = f.name
+            write_concat_list(f, files, timestamps)
+        cmd = build_copy_command(ffmpeg_path, list_file, output, timestamps)
+        try:
+            with Profiler.command(cmd):
+                subprocess.run(cmd, check=True)
+        finally:
+            os.remove(list_file)
+    else:
+        cmd = build_reencode_command(ffmpeg_path, files, output, encoder, crf)
+        if "[a]" not in cmd:
+            print("Warning: not every input has audio, output has none")
+        with Profiler.command(cmd):
+            subprocess.run(cmd, check=True)
+
+    os.utime(output, (last_modified_time, last_modified_time))
+    return True
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Concatenate video files. Inputs are probed in parallel "
+            "first: stream copy if they match, re-encode otherwise.")
+    parser.add_argument("input_dir", nargs="?", default=".",
+                        help="Directory with input files (default: .)")
+    parser.add_argument("-g", "--glob", default="*.mp4",
+                        help="Case-insensitive file name pattern (default: *.mp4)")
+    parser.add_argument("-s", "--sort", choices=SORT_KEYS, default="ctime",
+                        help="Order of the inputs, creation_time is the "
+                            "embedded tag with mtime as fallback (default: ctime)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Output file (default: output.mp4 in input_dir), "
+                            "never used as an input")
+    parser.add_argument("-m", "--mode", choices=MODES, default="auto",
+                        help="copy: concat demuxer with -c copy, reencode: "
+                            "concat filter, auto: copy if the pre-flight "
+                            "check passes (default: auto)")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="Parallel ffprobe runs (default: 8)")
+    parser.add_argument("--ffmpeg", default=FFMPEG_PATH,
+                        help=f"ffmpeg executable (default: {FFMPEG_PATH})")
+    parser.add_argument("--encoder", default="libx264",
+                        help="Video encoder for reencode (default: libx264)")
+    parser.add_argument("--crf", type=int, default=20,
+                        help="CRF for reencode (default: 20)")
+    parser.add_argument("-t", "--timestamps", choices=TIMESTAMP_MODES,
+                        default="keep",
+                        help="repair: for stream copy, trim each input to "
+                            "where all streams have data and write "
+                            "inpoint/outpoint/duration to the concat list, "
+                            "against audio drift and non-monotonic DTS "
+                            "(default: keep)")
+    parser.add_argument("--profile", default=None,
+                        help="Write a Chrome trace-event JSON of phases and "
+                            "ffmpeg/ffprobe runs to this file")
+    return parser.parse_args()
 
-    # Remove the temporary file list
-    os.remove(file_list)
-    os.utime("output.mp4", (last_modified_time, last_modified_time))
 
-# Call the function to glue MP4 files
-glue_mp4_files()
\ No newline at end of file
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.profile:
+        Profiler.enable(args.profile)
+    ok = glue_mp4_files(args.input_dir, args.glob, args.sort, args.output,
+                        args.mode, max(1, args.jobs), args.ffmpeg,
+                        args.encoder, args.crf, args.timestamps)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import statistics
+import subprocess
+
+# Seconds between samples of the process tree (Linux only)
+SAMPLE_INTERVAL = 0.02
+
+# Phase of a child process, from its executable and arguments
+PHASES = ["probe", "encode", "mux"]
+
+# Metrics reported per run, in print order
+METRICS = ["wall", "user", "sys", "peak_rss", "read_bytes", "write_bytes",
+           "rchar", "wchar"] + [f"phase_{phase}" for phase in PHASES]
+BYTE_METRICS = {"peak_rss", "read_bytes", "write_bytes", "rchar", "wchar"}
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+HAS_PROC = os.path.isdir("/proc/self")
+
+
+def read_proc_file(pid, name):
+    """Read /proc/<pid>/<name>, None if the process is gone"""
+    try:
+        with open(f"/proc/{pid}/{name}", "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def get_process_tree(root_pid):
+    """Get pids of root_pid and all its descendants from /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        stat = read_proc_file(entry, "stat")
+        if not stat:
+            continue
+        # comm may contain spaces and parentheses, fields follow the last ')'
+        fields = stat[stat.rfind(b")") + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def read_io(pid):
+    """Get /proc/<pid>/io counters, {} if unavailable"""
+    data = read_proc_file(pid, "io")
+    if not data:
+        return {}
+    counters = {}
+    for line in data.decode().splitlines():
+        key, _, value = line.partition(":")
+        counters[key] = int(value)
+    return counters
+
+
+def get_phase(cmdline):
+    """Classify a child process: ffprobe is probe, ffmpeg stream copy or
+    concat is mux, any other ffmpeg is encode, None for the rest"""
+    # Wrapper scripts run as "interpreter script args"
+    exe = next((os.path.basename(arg).lower() for arg in cmdline[:2]
+                if os.path.basename(arg).lower().startswith("ff")), "")
+    if exe.startswith("ffprobe"):
+        return "probe"
+    if not exe.startswith("ffmpeg"):
+        return None
+    for i, arg in enumerate(cmdline[:-1]):
+        if arg in ("-c", "-c:v", "-codec", "-vcodec") and cmdline[i + 1] == "copy":
+            return "mux"
+        if arg == "-f" and cmdline[i + 1] == "concat":
+            return "mux"
+    return "encode"
+
+
+def union_length(intervals):
+    """Total length covered by (start, end) intervals"""
+    total, current_start, current_end = 0.0, None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+class TreeSampler:
+    """Samples RSS, /proc io counters and phases of a process tree. Short
+    processes that start and exit between two samples are missed, so io
+    bytes and phase times are lower bounds"""
+    def __init__(self, root_pid, start, interval=SAMPLE_INTERVAL):
+        self.root_pid = root_pid
+        self.start = start
+        self.interval = interval
+        self.peak_rss = 0
+        self.io = {}  # pid -> last io counters
+        self.processes = {}  # pid -> [phase, first seen, last seen]
+
+    def sample(self):
+        now = time.perf_counter() - self.start
+        rss = 0
+        for pid in get_process_tree(self.root_pid):
+            statm = read_proc_file(pid, "statm")
+            if statm:
+                rss += int(statm.split()[1]) * PAGE_SIZE
+            counters = read_io(pid)
+            if counters:
+                self.io[pid] = counters
+            if pid not in self.processes:
+                cmdline = read_proc_file(pid, "cmdline") or b""
+                args = [arg.decode(errors="replace")
+                        for arg in cmdline.split(b"\0") if arg]
+                self.processes[pid] = [get_phase(args), now, now]
+            else:
+                self.processes[pid][2] = now
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def get_io(self, key):
+        return sum(counters.get(key, 0) for counters in self.io.values())
+
+    def get_phase_times(self):
+        intervals = {phase: [] for phase in PHASES}
+        for phase, first_seen, last_seen in self.processes.values():
+            if phase:
+                # A process seen once still ran for about one interval
+                intervals[phase].append(
+                    (first_seen, max(last_seen, first_seen + self.interval)))
+        return {phase: union_length(spans) for phase, spans in intervals.items()}
+
+
+def run_once(cmd, interval=SAMPLE_INTERVAL):
+    """Run cmd once and measure it. CPU times cover the whole tree as long
+    as every process is waited for by its parent. Peak RSS is the sum over
+    the tree on Linux, the largest single process elsewhere"""
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd)
+    result = {metric: None for metric in METRICS}
+    sampler = TreeSampler(process.pid, start, interval) if HAS_PROC else None
+
+    if hasattr(os, "wait4"):
+        while True:
+            if sampler:
+                sampler.sample()
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            time.sleep(interval)
+        wall = time.perf_counter() - start
+        # Popen must not wait for the pid that was just reaped
+        process.returncode = os.waitstatus_to_exitcode(status)
+        result["user"] = rusage.ru_utime
+        result["sys"] = rusage.ru_stime
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        maxrss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        result["peak_rss"] = max(maxrss, sampler.peak_rss if sampler else 0)
+    else:
+        process.wait()
+        wall = time.perf_counter() - start
+
+    result["wall"] = wall
+    result["returncode"] = process.returncode
+    if sampler:
+        for key in ("read_bytes", "write_bytes", "rchar", "wchar"):
+            result[key] = sampler.get_io(key)
+        for phase, seconds in sampler.get_phase_times().items():
+            result[f"phase_{phase}"] = seconds
+    return result
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def summarize(runs):
+    """Get median, p95, min and max per metric over runs"""
+    summary = {}
+    for metric in METRICS:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        if values:
+            summary[metric] = {
+                "median": statistics.median(values),
+                "p95": percentile(values, 95),
+                "min": min(values),
+                "max": max(values),
+            }
+    return summary
+
+
+def format_value(metric, value):
+    if metric in BYTE_METRICS:
+        for unit in ("B", "KiB", "MiB", "GiB"):
+            if abs(value) < 1024 or unit == "GiB":
+                return f"{value:.1f}{unit}" if unit != "B" else f"{value:.0f}B"
+            value /= 1024
+    return f"{value:.3f}s"
+
+
+def print_summary(summary, runs, baseline=None):
+    print(f"\n{len(runs)} run(s)")
+    header = f"{'metric':<14}{'median':>12}{'p95':>12}{'min':>12}{'max':>12}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    print(header)
+    for metric, stats in summary.items():
+        line = f"{metric:<14}" + "".join(
+            f"{format_value(metric, stats[key]):>12}"
+            for key in ("median", "p95", "min", "max"))
+        base = (baseline or {}).get(metric, {}).get("median")
+        if base:
+            line += f"{(stats['median'] - base) / base * 100:>+9.1f}%"
+        print(line)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Time a command: wall, user and sys CPU, peak RSS of the "
+            "process tree, /proc io bytes and probe/encode/mux phases "
+            "(ffprobe, ffmpeg, ffmpeg stream copy), with median/p95 over "
+            "repeated runs. Tree RSS, io and phases need Linux /proc.",
+        usage="%(prog)s [options] -- command [args ...]")
+    parser.add_argument("-n", "--repeat", type=int, default=1,
+                        help="Measured runs (default: 1)")
+    parser.add_argument("-w", "--warmup", type=int, default=0,
+                        help="Unmeasured runs before the measured ones "
+                            "(default: 0)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Write runs and summary to this JSON file")
+    parser.add_argument("-b", "--baseline", default=None,
+                        help="JSON file from --output to compare medians with")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL,
+                        help=f"Process tree sample interval in seconds "
+                            f"(default: {SAMPLE_INTERVAL})")
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+                        help="Command to run")
+    args = parser.parse_args()
+    if args.command[:1] == ["--"]:
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error("no command given")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["summary"]
+
+    for _ in range(args.warmup):
+        run_once(args.command, args.interval)
+    runs = []
+    for i in range(max(1, args.repeat)):
+        run = run_once(args.command, args.interval)
+        runs.append(run)
+        print(f"Run {i + 1}: {run['wall']:.3f}s, exit code {run['returncode']}")
+
+    summary = summarize(runs)
+    print_summary(summary, runs, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"command": args.command, "runs": runs,
+                       "summary": summary}, f, indent=2)
+    returncode = max((run["returncode"] for run in runs), key=abs)
+    # Killed by a signal: exit like a shell would, 128 + signal number
+    sys.exit(128 - returncode if returncode < 0 else returncode)
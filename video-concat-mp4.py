@@ -9,9 +9,17 @@
 # ==============================================================================
 
 import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
 import subprocess
 import datetime
 import argparse
+import functools
+from functools import lru_cache
 from collections import Counter
 import concurrent.futures
 
@@ -277,7 +285,128 @@ class Logger:
 # End of Logger class
 # ==============================================================================
 
+# Probe results are cached per file version (path, size, mtime), a worker
+# of encode-queue.py keeps them across jobs
+PROBE_CACHE_SIZE = 4096
 
+# ==============================================================================
+# Profiler class
+# v1.1.0
+# ==============================================================================
+
+class Profiler:
+    """Records timing spans of phases and subprocesses and saves them as
+    Chrome trace-event JSON, viewable in chrome://tracing or
+    https://ui.perfetto.dev. Does nothing until enable() is called"""
+    path = None
+    events = []
+    tracks = {}
+    origin = time.perf_counter()
+
+    @staticmethod
+    def enable(path):
+        """Start recording and save to path on exit
+
+        Args:
+            path (str): Trace file path
+        """
+        Profiler.path = path
+        atexit.register(Profiler.save)
+
+    @staticmethod
+    def get_track():
+        """Get the trace row of the caller: its asyncio task, so concurrent
+        tasks do not overlap on one row, otherwise its thread"""
+        asyncio = sys.modules.get("asyncio")
+        task = None
+        if asyncio:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                pass
+        if task:
+            track, name = id(task), task.get_name()
+        else:
+            thread = threading.current_thread()
+            track, name = thread.ident, thread.name
+        Profiler.tracks[track] = name
+        return track
+
+    @staticmethod
+    def add(name, category, start, end, track, args=None):
+        """Add a complete event, start and end from time.perf_counter()"""
+        Profiler.events.append({
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - Profiler.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": track, "args": args or {},
+        })
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category="phase", **args):
+        """Context manager recording a span around its body
+
+        Args:
+            name (str): Span name
+            category (str): Span category
+            **args: Extra values shown with the span
+        """
+        if Profiler.path is None:
+            yield
+            return
+        track = Profiler.get_track()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Profiler.add(name, category, start, time.perf_counter(), track,
+                         args)
+
+    @staticmethod
+    def wrap(func):
+        """Decorator recording a span named after func for every call"""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def command(command):
+        """Context manager recording a span around running command, named
+        after its executable
+
+        Args:
+            command (list): Command line of the process
+        """
+        return Profiler.span(os.path.basename(str(command[0])), "subprocess",
+                             command=" ".join(map(str, command)))
+
+    @staticmethod
+    def save():
+        """Write the recorded spans to the trace file"""
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                     "tid": track, "args": {"name": name}}
+                    for track, name in Profiler.tracks.items()]
+        directory = os.path.dirname(os.path.abspath(Profiler.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(Profiler.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + Profiler.events,
+                       "displayTimeUnit": "ms"}, f)
+
+# ==============================================================================
+# End of Profiler class
+# ==============================================================================
+
+
+@Profiler.wrap
 def get_sorted_videos(directory, fextension='.mp4'):
     try:
         video_files = [f for f in os.listdir(directory) if f.lower().endswith(fextension.lower())]
@@ -289,67 +418,106 @@ def get_sorted_videos(directory, fextension='.mp4'):
     return [video[0] for video in sorted_videos]
 
 
+def cache_probe(func):
+    """Cache func(video_file) by path, size and modification time, so an
+    unchanged file is probed once per process.
+
+    Args:
+        func (callable): Probe taking the file path
+    """
+    @lru_cache(maxsize=PROBE_CACHE_SIZE)
+    def cached(path, size, mtime):
+        return func(path)
+
+    @functools.wraps(func)
+    def wrapper(video_file):
+        try:
+            stat = os.stat(video_file)
+        except OSError:
+            return func(video_file)
+        return cached(os.path.abspath(video_file), stat.st_size, 
+                      stat.st_mtime_ns)
+    return wrapper
+
+
+@cache_probe
 def get_video_codec(video_file):
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', \
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', \
         'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', \
-        video_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+        video_file]
+    with Profiler.command(command):
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
     return result.stdout.decode().strip()
 
 
+@cache_probe
 def get_audio_codec(video_file):
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', \
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', \
         'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', \
-        video_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+        video_file]
+    with Profiler.command(command):
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
     return result.stdout.decode().strip()
 
 
+@cache_probe
 def get_video_resolution(video_file):
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', \
-        'stream=width,height', '-of', 'csv=p=0', video_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', \
+        'stream=width,height', '-of', 'csv=p=0', video_file]
+    with Profiler.command(command):
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
     width, height = result.stdout.decode().strip().split(',')
     return int(width), int(height)
 
 
+@cache_probe
 def get_video_bitrate(video_file):
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', \
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', \
         'stream=bit_rate', '-of', 'default=noprint_wrappers=1:nokey=1', \
-        video_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+        video_file]
+    with Profiler.command(command):
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
     return int(result.stdout.decode().strip())
 
 
+@cache_probe
 def get_audio_bitrate(video_file):
-    result = subprocess.run(
-        ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', \
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', \
         'stream=bit_rate', '-of', 'default=noprint_wrappers=1:nokey=1', 
-        video_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+        video_file]
+    with Profiler.command(command):
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
     return int(result.stdout.decode().strip())
 
 
+@Profiler.wrap
 def find_most_common_video_codec(video_list):
     with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
         codecs = list(executor.map(get_video_codec, video_list))
     most_common_codec = Counter(codecs).most_common(1)[0][0]
     return most_common_codec
 
+@Profiler.wrap
 def find_most_common_audio_codec(video_list):
     with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
         codecs = list(executor.map(get_audio_codec, video_list))
@@ -357,17 +525,20 @@ def find_most_common_audio_codec(video_list):
     return most_common_codec
 
 
+@Profiler.wrap
 def count_video_codecs(video_list):
     with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
         codecs = list(executor.map(get_video_codec, video_list))
     return Counter(codecs)
 
+@Profiler.wrap
 def count_audio_codecs(video_list):
     with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
         codecs = list(executor.map(get_audio_codec, video_list))
     return Counter(codecs)
 
 
+@Profiler.wrap
 def convert_to(filename, bitrate, new_file_extension='mp4', v_codec='h264', a_codec='aac', scale='scale=1280:720'):
     # Get video folder to save the new video
     video_folder = os.path.dirname(filename)
@@ -391,8 +562,9 @@ def convert_to(filename, bitrate, new_file_extension='mp4', v_codec='h264', a_co
         '-c:a', a_codec,
         new_filename
     ]
-    result = subprocess.run(ffmpeg_command, stdout=subprocess.PIPE, 
-                              stderr=subprocess.PIPE)
+    with Profiler.command(ffmpeg_command):
+        result = subprocess.run(ffmpeg_command, stdout=subprocess.PIPE, 
+                                stderr=subprocess.PIPE)
     if result.stdout:
         Logger.info(result.stdout.decode())
     if result.stderr:
@@ -403,6 +575,7 @@ def convert_to(filename, bitrate, new_file_extension='mp4', v_codec='h264', a_co
     return new_filename
 
 
+@Profiler.wrap
 def many_convert_to(video_list, bitrate, new_file_extension, v_codec='h264', a_codec='aac', scale='scale=1280:720'):
     raws = []
     for video in video_list:
@@ -422,6 +595,7 @@ def set_file_modif_datetime(filename, last_modified_time):
     os.utime(filename, (last_modified_time, last_modified_time))
 
 
+@Profiler.wrap
 def concatenate_videos(video_list, output_file, codec, bitrate, audio_codec):
     temp_folder = os.path.dirname(video_list[0])
     # Create temp folder if it doesn't exist
@@ -462,8 +636,9 @@ def concatenate_videos(video_list, output_file, codec, bitrate, audio_codec):
         output_file
     ]
     # Execute the ffmpeg command
-    result = subprocess.run(ffmpeg_command, stdout=subprocess.PIPE, 
-                              stderr=subprocess.PIPE)
+    with Profiler.command(ffmpeg_command):
+        result = subprocess.run(ffmpeg_command, stdout=subprocess.PIPE, 
+                                stderr=subprocess.PIPE)
     if result.stdout:
         Logger.info(result.stdout.decode())
     if result.stderr:
@@ -479,7 +654,10 @@ def fancy_int(number):
     return "{:_}".format(number)
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    global LOG_LEVEL, LOG_FILE
+    directory = None
+    returncode = 0
     try:
         parser = argparse.ArgumentParser(
             description="Concatenate multiple mp4 files into a single video.")
@@ -514,13 +692,24 @@ if __name__ == "__main__":
         parser.add_argument(
             "--file-extension", type=str, default=".mp4",
             help="File extension to search for. Default: '.mp4'.")
+        parser.add_argument(
+            "--profile", type=str, default="",
+            help="Write a Chrome trace-event JSON of phases and " \
+                + "ffmpeg/ffprobe runs to this file. Default: off.")
         
 
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
+        if args.profile:
+            Profiler.enable(args.profile)
 
         LOG_LEVEL = LOG_LEVELS[args.log_level]
         LOG_FILE = os.path.join(args.directory, '.logs', 'video-concat-mp4.log')
 
+        # Nobody can answer the prompt, e.g. in an encode-queue worker
+        if not args.yes and not sys.stdin.isatty():
+            Logger.error("stdin is not a terminal, pass -y to skip the prompt")
+            exit(2)
+
         v_codec = args.v_codec
         a_codec = args.a_codec
 
@@ -575,7 +764,7 @@ if __name__ == "__main__":
             and ok != '') \
             and not args.yes:
             Logger.error("User aborted")
-            exit()
+            exit(1)
 
         raws = many_convert_to(sorted_videos, video_bitrate, output_extension, v_codec, a_codec, scale=resolution)
         concatenate_videos(raws, output_file, v_codec, video_bitrate, a_codec)
@@ -590,14 +779,20 @@ if __name__ == "__main__":
 
     except Exception as e:
         Logger.error(str(e), do_inspect=True)
+        returncode = 1
     except KeyboardInterrupt:
         Logger.error("KeyboardInterrupt")
+        returncode = 130
 
-    if os.path.exists(os.path.join(directory, '.temp')):
+    if directory and os.path.exists(os.path.join(directory, '.temp')):
         files = os.listdir(os.path.join(directory, '.temp'))
         for file in files:
             os.remove(os.path.join(directory, '.temp', file))
         os.rmdir(os.path.join(directory, '.temp'))
         Logger.info("Removed temp folder")
 
-    exit()
+    exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -268,11 +268,142 @@ class Logger:
 # End of Logger class
 # ==============================================================================
 
-import os, argparse, subprocess
+import os, sys, argparse
+import io
 import json
-import concurrent.futures
-import signal
-from threading import Event
+import struct
+from array import array
+import asyncio
+import csv
+import functools
+import itertools
+import math
+import time
+import atexit
+import sqlite3
+import threading
+import contextlib
+try:
+    # Optional, frames are hashed in pure Python without it
+    import numpy
+except ImportError:
+    numpy = None
+
+# ==============================================================================
+# Profiler class
+# v1.1.0
+# ==============================================================================
+
+class Profiler:
+    """Records timing spans of phases and subprocesses and saves them as
+    Chrome trace-event JSON, viewable in chrome://tracing or
+    https://ui.perfetto.dev. Does nothing until enable() is called"""
+    path = None
+    events = []
+    tracks = {}
+    origin = time.perf_counter()
+
+    @staticmethod
+    def enable(path):
+        """Start recording and save to path on exit
+
+        Args:
+            path (str): Trace file path
+        """
+        Profiler.path = path
+        atexit.register(Profiler.save)
+
+    @staticmethod
+    def get_track():
+        """Get the trace row of the caller: its asyncio task, so concurrent
+        tasks do not overlap on one row, otherwise its thread"""
+        asyncio = sys.modules.get("asyncio")
+        task = None
+        if asyncio:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                pass
+        if task:
+            track, name = id(task), task.get_name()
+        else:
+            thread = threading.current_thread()
+            track, name = thread.ident, thread.name
+        Profiler.tracks[track] = name
+        return track
+
+    @staticmethod
+    def add(name, category, start, end, track, args=None):
+        """Add a complete event, start and end from time.perf_counter()"""
+        Profiler.events.append({
+            "name": name, "cat": category, "ph": "X",
+            "ts": (start - Profiler.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": track, "args": args or {},
+        })
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category="phase", **args):
+        """Context manager recording a span around its body
+
+        Args:
+            name (str): Span name
+            category (str): Span category
+            **args: Extra values shown with the span
+        """
+        if Profiler.path is None:
+            yield
+            return
+        track = Profiler.get_track()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Profiler.add(name, category, start, time.perf_counter(), track,
+                         args)
+
+    @staticmethod
+    def wrap(func):
+        """Decorator recording a span named after func for every call"""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Profiler.span(func.__name__):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def command(command):
+        """Context manager recording a span around running command, named
+        after its executable
+
+        Args:
+            command (list): Command line of the process
+        """
+        return Profiler.span(os.path.basename(str(command[0])), "subprocess",
+                             command=" ".join(map(str, command)))
+
+    @staticmethod
+    def save():
+        """Write the recorded spans to the trace file"""
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                     "tid": track, "args": {"name": name}}
+                    for track, name in Profiler.tracks.items()]
+        directory = os.path.dirname(os.path.abspath(Profiler.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(Profiler.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + Profiler.events,
+                       "displayTimeUnit": "ms"}, f)
+
+# ==============================================================================
+# End of Profiler class
+# ==============================================================================
 
 def read_file_label(filepath: str) -> list:
     """Read label from file. Label contains in the name of the file.
@@ -290,56 +421,446 @@ def read_file_label(filepath: str) -> list:
     label = filename.split('[')[1].split(']')[0].split(',')
     return label
 
-def generate_video_data(filepath: str) -> dict:
-    """Generate video label. Using ffprobe to get video metadata.
+def parse_frame_rate(rate: str) -> float:
+    """Parse ffprobe frame rate ('30000/1001', '25', '0/0').
 
     Args:
-        directory (str): Directory with video files
+        rate (str): Frame rate
+
+    Returns:
+        float: Frame rate, 0 if unknown
+    """
+    if not rate:
+        return 0
+    num, _, den = str(rate).partition('/')
+    try:
+        num, den = float(num), float(den or 1)
+    except ValueError:
+        return 0
+    return num / den if den else 0
+
+
+# ==============================================================================
+# Header-only metadata reader for MP4/MOV and Matroska/WebM
+# ==============================================================================
+
+# Sample entry fourcc -> ffprobe codec_name
+MP4_CODECS = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc',
+    'av01': 'av1', 'vp09': 'vp9', 'vp08': 'vp8', 'mp4v': 'mpeg4',
+    's263': 'h263', 'jpeg': 'mjpeg', 'mjpa': 'mjpeg',
+    'apch': 'prores', 'apcn': 'prores', 'apcs': 'prores', 'apco': 'prores', 
+    'ap4h': 'prores', 'ap4x': 'prores',
+}
+# Matroska CodecID -> ffprobe codec_name
+MKV_CODECS = {
+    'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc', 'V_AV1': 'av1',
+    'V_VP9': 'vp9', 'V_VP8': 'vp8', 'V_MPEG4/ISO/ASP': 'mpeg4', 
+    'V_MPEG2': 'mpeg2video', 'V_MPEG1': 'mpeg1video', 'V_MJPEG': 'mjpeg',
+    'V_PRORES': 'prores', 'V_THEORA': 'theora',
+}
+MP4_TOP_LEVEL_BOXES = (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide')
+
+# Matroska element IDs
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMESTAMP_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_DEFAULT_DURATION = 0x23E383
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_CLUSTER = 0x1F43B675
+
+
+def iter_mp4_boxes(f, start: int, end: int):
+    """Iterate MP4 boxes between start and end, reading only box headers.
+
+    Yields:
+        tuple: (type, body start, box end)
+    """
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type.decode('latin-1'), offset + header_size, offset + size
+        offset += size
+
+
+def find_mp4_box(f, start: int, end: int, path: str):
+    """Find box by slash-separated path, e.g. 'mdia/minf/stbl'.
 
     Returns:
-        dict: Video label (resolution, fps, codec, bitrate)
+        tuple: (body start, box end) or None
+    """
+    for name in path.split('/'):
+        for box_type, body_start, box_end in iter_mp4_boxes(f, start, end):
+            if box_type == name:
+                start, end = body_start, box_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def read_mp4_video_track(f, start: int, end: int) -> dict:
+    """Read video track fields from a 'trak' box, None if not video."""
+    hdlr = find_mp4_box(f, start, end, 'mdia/hdlr')
+    if not hdlr:
+        return None
+    f.seek(hdlr[0] + 8)
+    if f.read(4) != b'vide':
+        return None
+
+    mdhd = find_mp4_box(f, start, end, 'mdia/mdhd')
+    f.seek(mdhd[0])
+    version = f.read(1)[0]
+    if version == 1:
+        f.seek(mdhd[0] + 20)
+        timescale, duration = struct.unpack('>IQ', f.read(12))
+    else:
+        f.seek(mdhd[0] + 12)
+        timescale, duration = struct.unpack('>II', f.read(8))
+
+    stbl = find_mp4_box(f, start, end, 'mdia/minf/stbl')
+    stsd = find_mp4_box(f, stbl[0], stbl[1], 'stsd')
+    # First sample entry follows version/flags and entry_count
+    entry_start = stsd[0] + 8
+    f.seek(entry_start)
+    entry_size, fourcc = struct.unpack('>I4s', f.read(8))
+    f.seek(entry_start + 32)
+    width, height = struct.unpack('>HH', f.read(4))
+    avg_bitrate = 0
+    # Child boxes follow the 86-byte VisualSampleEntry
+    for box_type, body_start, _ in iter_mp4_boxes(
+            f, entry_start + 86, entry_start + entry_size):
+        if box_type == 'btrt':
+            f.seek(body_start + 8)
+            avg_bitrate = struct.unpack('>I', f.read(4))[0]
+
+    stsz = find_mp4_box(f, stbl[0], stbl[1], 'stsz')
+    f.seek(stsz[0] + 4)
+    sample_size, sample_count = struct.unpack('>II', f.read(8))
+    seconds = duration / timescale if timescale else 0
+    if not avg_bitrate and seconds > 0:
+        if sample_size:
+            total_size = sample_size * sample_count
+        else:
+            sizes = array('I', f.read(4 * sample_count))
+            if sys.byteorder == 'little':
+                sizes.byteswap()
+            total_size = sum(sizes)
+        avg_bitrate = total_size * 8 / seconds
+    return {
+        'codec': MP4_CODECS.get(fourcc.decode('latin-1')),
+        'width': width,
+        'height': height,
+        'fps': sample_count / seconds if seconds > 0 else 0,
+        'bitrate': avg_bitrate,
+        'duration': seconds,
+    }
+
+
+def read_mp4_header(f, file_size: int) -> dict:
+    moov = find_mp4_box(f, 0, file_size, 'moov')
+    if not moov:
+        return None
+    for box_type, body_start, box_end in iter_mp4_boxes(f, *moov):
+        if box_type == 'trak':
+            track = read_mp4_video_track(f, body_start, box_end)
+            if track:
+                return track
+    return None
+
+
+def read_ebml_vint(f, keep_marker: bool = False):
+    """Read EBML variable-size integer. Element IDs keep the length marker.
+
+    Returns:
+        tuple: (value, unknown size flag)
+    """
+    first = f.read(1)
+    if not first:
+        raise EOFError('Unexpected end of EBML data')
+    length, mask = 1, 0x80
+    while length <= 8 and not first[0] & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ValueError('Invalid EBML variable-size integer')
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    for byte in f.read(length - 1):
+        value = (value << 8) | byte
+    return value, not keep_marker and value == (1 << (7 * length)) - 1
+
+
+def iter_ebml_elements(f, end: int):
+    """Iterate EBML elements up to end, stops at an element of unknown size.
+
+    Yields:
+        tuple: (element ID, body start, body size or None if unknown)
+    """
+    while f.tell() < end:
+        element_id, _ = read_ebml_vint(f, keep_marker=True)
+        size, unknown = read_ebml_vint(f)
+        start = f.tell()
+        yield element_id, start, None if unknown else size
+        if unknown:
+            return
+        f.seek(start + size)
+
+
+def read_ebml_uint(f, size: int) -> int:
+    return int.from_bytes(f.read(size), 'big')
+
+
+def read_mkv_video_track(data: bytes) -> dict:
+    """Read first video track from the body of a Tracks element."""
+    tracks = io.BytesIO(data)
+    for element_id, start, size in iter_ebml_elements(tracks, len(data)):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        track = {}
+        for child_id, _, child_size in iter_ebml_elements(tracks, start + size):
+            if child_id == MKV_TRACK_TYPE:
+                track['type'] = read_ebml_uint(tracks, child_size)
+            elif child_id == MKV_CODEC_ID:
+                track['codec_id'] = tracks.read(child_size).decode('ascii').rstrip('\0')
+            elif child_id == MKV_DEFAULT_DURATION:
+                track['default_duration'] = read_ebml_uint(tracks, child_size)
+            elif child_id == MKV_VIDEO:
+                video_end = tracks.tell() + child_size
+                for video_id, _, video_size in iter_ebml_elements(tracks, video_end):
+                    if video_id == MKV_PIXEL_WIDTH:
+                        track['width'] = read_ebml_uint(tracks, video_size)
+                    elif video_id == MKV_PIXEL_HEIGHT:
+                        track['height'] = read_ebml_uint(tracks, video_size)
+        if track.get('type') == 1:
+            return track
+    return None
+
+
+def read_mkv_header(f, file_size: int) -> dict:
+    f.seek(0)
+    segment = None
+    for element_id, start, size in iter_ebml_elements(f, file_size):
+        if element_id == MKV_SEGMENT:
+            segment = (start, start + size if size is not None else file_size)
+            break
+    if not segment:
+        return None
+
+    timestamp_scale, duration, track = 1000000, 0, None
+    f.seek(segment[0])
+    # Info and Tracks precede the first Cluster, media data is never read
+    for element_id, start, size in iter_ebml_elements(f, segment[1]):
+        if element_id == MKV_CLUSTER or size is None:
+            break
+        if element_id == MKV_INFO:
+            info = io.BytesIO(f.read(size))
+            for info_id, _, info_size in iter_ebml_elements(info, size):
+                if info_id == MKV_TIMESTAMP_SCALE:
+                    timestamp_scale = read_ebml_uint(info, info_size)
+                elif info_id == MKV_DURATION:
+                    duration = struct.unpack(
+                        '>f' if info_size == 4 else '>d', info.read(info_size))[0]
+        elif element_id == MKV_TRACKS:
+            track = read_mkv_video_track(f.read(size))
+        if track and duration:
+            break
+    if not track:
+        return None
+
+    seconds = duration * timestamp_scale / 1e9
+    default_duration = track.get('default_duration')
+    return {
+        'codec': MKV_CODECS.get(track.get('codec_id')),
+        'width': track.get('width'),
+        'height': track.get('height'),
+        'fps': 1e9 / default_duration if default_duration else 0,
+        # No per-stream bitrate in Matroska, use the container bitrate
+        'bitrate': file_size * 8 / seconds if seconds > 0 else 0,
+        'duration': seconds,
+    }
+
+
+def read_video_header(filepath: str) -> dict:
+    """Read video metadata from MP4/MOV or Matroska/WebM headers without 
+    ffprobe, seeking over the media data.
+
+    Args:
+        filepath (str): Video file
+
+    Returns:
+        dict: Same as parse_ffprobe_output(), None if the file can not be 
+            parsed or a field is missing
     """
     try:
-        # Run ffprobe to get video metadata
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,r_frame_rate,codec_name,bit_rate', '-of', 'json', filepath],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        file_size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            magic = f.read(8)
+            if magic[:4] == struct.pack('>I', EBML_HEADER):
+                data = read_mkv_header(f, file_size)
+            elif magic[4:8] in MP4_TOP_LEVEL_BOXES:
+                data = read_mp4_header(f, file_size)
+            else:
+                return None
+    except (OSError, EOFError, ValueError, TypeError, IndexError, 
+            UnicodeDecodeError, struct.error) as e:
+        Logger.debug(f"Header not parsed: '{filepath}': {e}")
+        return None
+    if not data or not all(data[key] for key in 
+                           ('codec', 'width', 'height', 'fps', 'bitrate')):
+        return None
+    return {
+        'resolution': f"{data['width']}x{data['height']}",
+        'fps': data['fps'],
+        'codec': data['codec'],
+        'bitrate': f"{int(data['bitrate']) // 1000} kbps",
+        'duration': data['duration'],
+        'size': file_size,
+    }
+
+# ==============================================================================
+# End of header-only metadata reader
+# ==============================================================================
+
+
+def get_ffprobe_command(filepath: str) -> list:
+    """Get ffprobe command that reads stream and container metadata.
+
+    Args:
+        filepath (str): Video file
+
+    Returns:
+        list: ffprobe command
+    """
+    return ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,r_frame_rate,avg_frame_rate,codec_name,bit_rate:format=bit_rate,size,duration', '-of', 'json', filepath]
+
+
+def parse_ffprobe_output(filepath: str, output: str) -> dict:
+    """Parse ffprobe JSON output. Bitrate falls back to the container
+    bitrate, then to size / duration; frame rate falls back to
+    avg_frame_rate.
+
+    Args:
+        filepath (str): Video file
+        output (str): ffprobe JSON output
+
+    Returns:
+        dict: Video label (resolution, fps, codec, bitrate, duration, size)
+    """
+    # Parse the JSON output
+    metadata = json.loads(output)
+    stream = metadata['streams'][0]
+    fmt = metadata.get('format', {})
+    
+    # Extract required information
+    resolution = f"{stream['width']}x{stream['height']}"
+    fps = parse_frame_rate(stream.get('r_frame_rate')) \
+        or parse_frame_rate(stream.get('avg_frame_rate'))
+    codec = stream['codec_name']
+    duration = float(fmt.get('duration') or 0)
+    size = int(fmt.get('size') or 0)
+    if str(stream.get('bit_rate', 'N/A')).isdigit():
+        bitrate = int(stream['bit_rate'])
+    elif str(fmt.get('bit_rate', 'N/A')).isdigit():
+        bitrate = int(fmt['bit_rate'])
+    elif duration > 0:
+        bitrate = int(size * 8 / duration)
+    else:
+        bitrate = 0
+    bitrate = bitrate // 1000  # Convert to kbps
+    
+    Logger.debug(f"File: '{filepath}', resolution: {resolution}, fps: {fps}, codec: {codec}, bitrate: {bitrate}Kbps")
+    return {
+        'resolution': resolution,
+        'fps': fps,
+        'codec': codec,
+        'bitrate': f"{bitrate} kbps",
+        'duration': duration,
+        'size': size,
+    }
+
+
+async def run_command_async(cmd: list) -> tuple:
+    """Run command without blocking the event loop. The process is killed
+    if the task is cancelled.
+
+    Args:
+        cmd (list): Command
+
+    Returns:
+        tuple: (return code, stdout bytes, stderr bytes)
+    """
+    with Profiler.command(cmd):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
-        
-        # Parse the JSON output
-        metadata = json.loads(result.stdout)
-        stream = metadata['streams'][0]
-        
-        # Extract required information
-        resolution = f"{stream['width']}x{stream['height']}"
-        fps = eval(stream['r_frame_rate'])
-        codec = stream['codec_name']
-        bitrate = int(stream['bit_rate']) // 1000  # Convert to kbps
-        
-        Logger.debug(f"File: '{filepath}', resolution: {resolution}, fps: {fps}, codec: {codec}, bitrate: {bitrate}Kbps")
-        return {
-            'resolution': resolution,
-            'fps': fps,
-            'codec': codec,
-            'bitrate': f"{bitrate} kbps"
-        }
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # Don't leave ffprobe/ffmpeg running after Ctrl-C
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+    return process.returncode, stdout, stderr
+
+
+async def generate_video_data_async(filepath: str, fast: bool = True) -> dict:
+    """Generate video label without blocking the event loop. ffprobe is 
+    started with asyncio.create_subprocess_exec and killed if the task is 
+    cancelled.
+
+    Args:
+        filepath (str): Video file
+        fast (bool): Read MP4/MKV headers directly, ffprobe as fallback
+
+    Returns:
+        dict: Video label (resolution, fps, codec, bitrate, duration, size)
+    """
+    if fast:
+        data = await asyncio.to_thread(read_video_header, filepath)
+        if data:
+            Logger.debug(f"File: '{filepath}', from headers: {data}")
+            return data
+    try:
+        _, stdout, _ = await run_command_async(get_ffprobe_command(filepath))
+        return parse_ffprobe_output(filepath, stdout.decode(errors='replace'))
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         print(f"Error generating video label: {e}")
         return {}
     
 
-def generate_video_label(filepath: str) -> str:
-    """Generate video label. Using ffprobe to get video metadata.
+def format_video_label(data: dict) -> str:
+    """Format video label from video data.
 
     Args:
-        directory (str): Directory with video files
+        data (dict): Video data from generate_video_data_async
 
     Returns:
         str: Video label
     """
-    data = generate_video_data(filepath)
+    data = dict(data)
     data['resolution'] = data['resolution'].split('x')[1]
     data['bitrate'] = data['bitrate'].replace(' kbps', 'Kbps')
     bitrate = int(data['bitrate'].replace('Kbps', ''))
@@ -359,15 +880,17 @@ def generate_video_label(filepath: str) -> str:
     return f"[{data['resolution']}p,{data['fps']}fps,{data['codec']},{data['bitrate']}]"
     
 
-def write_video_label(filepath: str, label: str):
-    """Write label to file.
+def get_labeled_path(filepath: str, label: str) -> str:
+    """Get file path with label put into the file name.
 
     Args:
         filepath (str): File path
         label (str): Label
+
+    Returns:
+        str: New file path
     """
     filename = os.path.basename(filepath)
-    Logger.debug(f"Old filename: '{filename}'")
 
     # get every part of name, except extenstion
     filename_base = os.path.splitext(filename)[0]
@@ -378,69 +901,824 @@ def write_video_label(filepath: str, label: str):
     else:
         new_filename = filename_base.split('[')[0] + label + file_ext
         # new_filename = filename.split('[')[0] + label + filename.split(']')[1]
-    new_filepath = os.path.join(os.path.dirname(filepath), new_filename)
-    os.rename(filepath, new_filepath)
-    Logger.debug(f"Renamed file: '{filepath}' -> '{new_filepath}'")
+    return os.path.join(os.path.dirname(filepath), new_filename)
 
 
-def get_write_video_label(filepath: str):
-    """Get and write video label to file.
+@Profiler.wrap
+async def get_video_data_async(filepath: str, semaphore: asyncio.Semaphore, fast: bool = True) -> dict:
+    """Get video data, at most as many probes at once as the semaphore
+    allows.
 
     Args:
         filepath (str): File path
+        semaphore (asyncio.Semaphore): Limits concurrent probes
+        fast (bool): Read MP4/MKV headers directly, ffprobe as fallback
+
+    Returns:
+        dict: Same as generate_video_data_async(), empty on error
     """
+    started = False
     try:
-        # is file exists
-        if not os.path.exists(filepath):
-            Logger.error(f"File not found: '{filepath}'")
-            return
-        old_label = read_file_label(filepath)
-        old_label = '[' + ','.join(old_label) + ']'
-        label = generate_video_label(filepath)
+        async with semaphore:
+            if not os.path.exists(filepath):
+                Logger.error(f"File not found: '{filepath}'")
+                return {}
+            started = True
+            return await generate_video_data_async(filepath, fast)
+    except asyncio.CancelledError:
+        # Files still waiting for the semaphore are dropped silently
+        if started:
+            Logger.error(f"Interrupted processing file: '{filepath}'")
+        raise
+    except Exception as e:
+        Logger.error(f"Error processing file: '{filepath}': {e}")
+        return {}
+
+
+@Profiler.wrap
+async def probe_files(files: list, jobs: int, fast: bool = True) -> dict:
+    """Probe files concurrently in one event loop.
+
+    Args:
+        files (list): Video files
+        jobs (int): Max concurrent probes
+        fast (bool): Read MP4/MKV headers directly, ffprobe as fallback
+
+    Returns:
+        dict: File path -> video data, files that failed are left out
+    """
+    semaphore = asyncio.Semaphore(jobs)
+    results = await asyncio.gather(*(get_video_data_async(file, semaphore, fast)
+                                     for file in files))
+    return {file: data for file, data in zip(files, results) if data}
+
+
+@Profiler.wrap
+def plan_labels(video_data: dict) -> list:
+    """Plan renames from probed video data. Nothing is renamed here.
 
-        Logger.info(f"File: '{filepath}'")
+    Args:
+        video_data (dict): File path -> video data from probe_files
+
+    Returns:
+        list: (old path, new path) for every file whose label changes
+    """
+    plan = []
+    for filepath, data in video_data.items():
+        try:
+            label = format_video_label(data)
+        except Exception as e:
+            Logger.error(f"Error processing file: '{filepath}': {e}")
+            continue
+        old_label = '[' + ','.join(read_file_label(filepath)) + ']'
         if (old_label != label) and (label != '[]'):
-            write_video_label(filepath, label)
-            Logger.info(f"File: '{filepath}'")
-            Logger.info(f"Label changed: '{old_label}' -> '{label}'")
+            plan.append((filepath, get_labeled_path(filepath, label)))
         else:
-            Logger.info(f"Label correct: '{label}', skipping...")
-    except Exception as e:
-        Logger.error(f"Error processing file: '{filepath}': {e}")
-    except KeyboardInterrupt as e:
-        Logger.error(f"Interrupted processing file: '{filepath}'")
+            Logger.info(f"Label correct: '{filepath}', skipping...")
+    return plan
+
+
+def find_collisions(plan: list) -> list:
+    """Find planned renames whose new path is already taken, either by an
+    existing file or by another planned rename.
+
+    Args:
+        plan (list): (old path, new path) pairs from plan_labels
+
+    Returns:
+        list: Colliding (old path, new path) pairs
+    """
+    targets = {}
+    for old_path, new_path in plan:
+        key = os.path.normcase(os.path.abspath(new_path))
+        targets.setdefault(key, []).append((old_path, new_path))
+    collisions = []
+    for key, renames in targets.items():
+        if len(renames) > 1 or os.path.exists(key):
+            collisions.extend(renames)
+    return collisions
+
+
+def get_journal_path(directory: str) -> str:
+    """Get path for a new undo journal in directory.
+
+    Args:
+        directory (str): Directory with video files
+
+    Returns:
+        str: Journal path
+    """
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join(directory, f"{JOURNAL_PREFIX}{stamp}.jsonl")
+
+
+@Profiler.wrap
+def apply_renames(plan: list, journal: str) -> list:
+    """Rename files in one pass. Every rename is written to the journal
+    before it happens, so a crash halfway can still be undone.
+
+    Args:
+        plan (list): (old path, new path) pairs
+        journal (str): Undo journal path, appended to
+
+    Returns:
+        list: (old path, new path) pairs that were renamed
+    """
+    renamed = []
+    with open(journal, 'a', encoding='utf-8') as f:
+        for old_path, new_path in plan:
+            # os.rename overwrites on POSIX, so check once more right before
+            if os.path.exists(new_path):
+                Logger.warning(f"Target exists, skipping: '{new_path}'")
+                continue
+            # Absolute paths, so --undo works from any working directory
+            f.write(json.dumps({'from': os.path.abspath(old_path),
+                                'to': os.path.abspath(new_path)}) + '\n')
+            f.flush()
+            try:
+                os.rename(old_path, new_path)
+            except OSError as e:
+                Logger.error(f"Error renaming file: '{old_path}': {e}")
+                continue
+            renamed.append((old_path, new_path))
+            Logger.info(f"Renamed file: '{old_path}' -> '{new_path}'")
+        os.fsync(f.fileno())
+    return renamed
 
 
-def get_list_of_files(directory: str, ext: str) -> list:
+def undo_renames(journal: str) -> int:
+    """Revert renames recorded in an undo journal, newest first. Entries
+    whose rename never happened or was already reverted are skipped.
+
+    Args:
+        journal (str): Undo journal path
+
+    Returns:
+        int: Number of reverted files
+    """
+    with open(journal, 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    reverted = 0
+    for entry in reversed(entries):
+        if not os.path.exists(entry['to']) or os.path.exists(entry['from']):
+            Logger.warning(f"Cannot undo, skipping: '{entry['to']}'")
+            continue
+        os.rename(entry['to'], entry['from'])
+        reverted += 1
+        Logger.info(f"Reverted file: '{entry['to']}' -> '{entry['from']}'")
+    return reverted
+
+
+def get_list_of_files(directory: str, ext: str, recursive: bool = False) -> list:
     """Get list of files with specified extension in directory.
 
     Args:
         directory (str): Directory with video files
         ext (str): File extension
+        recursive (bool): Also look in subdirectories
 
     Returns:
         list: List of files
     """
+    if not recursive:
+        files = []
+        for file in os.listdir(directory):
+            if file.lower().endswith(ext.lower()):
+                files.append(os.path.join(directory, file))
+        return files
     files = []
-    for file in os.listdir(directory):
-        if file.lower().endswith(ext.lower()):
-            files.append(os.path.join(directory, file))
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        for file in sorted(filenames):
+            if file.lower().endswith(ext.lower()):
+                files.append(os.path.join(root, file))
     return files
 
-# Define a global event to signal threads to stop
-stop_event = Event()
 
-def signal_handler(sig, frame):
-    Logger.info("Interrupt received, shutting down...")
-    stop_event.set()
+# ==============================================================================
+# Video index
+# ==============================================================================
+INDEX_COLUMNS = ['path', 'resolution', 'width', 'height', 'fps', 'codec',
+                 'bitrate', 'duration', 'size']
+
+
+def open_index(index_path: str) -> sqlite3.Connection:
+    """Open SQLite video index, create it if missing.
+
+    Args:
+        index_path (str): Index path
+
+    Returns:
+        sqlite3.Connection: Index connection
+    """
+    index = sqlite3.connect(index_path)
+    index.execute(
+        'CREATE TABLE IF NOT EXISTS videos ('
+        'path TEXT PRIMARY KEY, resolution TEXT, width INTEGER, '
+        'height INTEGER, fps REAL, codec TEXT, bitrate INTEGER, '
+        'duration REAL, size INTEGER)')
+    index.execute(
+        'CREATE INDEX IF NOT EXISTS videos_codec_height '
+        'ON videos (codec, height)')
+    index.execute(
+        'CREATE TABLE IF NOT EXISTS signatures ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, frames INTEGER, '
+        'hashes TEXT, backend TEXT)')
+    columns = [row[1] for row in index.execute('PRAGMA table_info(signatures)')]
+    if 'backend' not in columns:
+        # Older indexes, their rows have no backend and are extracted again
+        index.execute('ALTER TABLE signatures ADD COLUMN backend TEXT')
+    return index
+
+
+@Profiler.wrap
+def update_index(index_path: str, video_data: dict, renames: list = ()) -> int:
+    """Write probed video data to the index, keyed by absolute path. Rows
+    of renamed files are moved to their new path.
+
+    Args:
+        index_path (str): Index path
+        video_data (dict): File path -> video data from probe_files
+        renames (list): (old path, new path) pairs that were applied
+
+    Returns:
+        int: Number of indexed files
+    """
+    new_paths = dict(renames)
+    rows = []
+    for filepath, data in video_data.items():
+        width, height = (int(x) for x in data['resolution'].split('x'))
+        rows.append((
+            os.path.abspath(new_paths.get(filepath, filepath)),
+            data['resolution'], width, height, data['fps'], data['codec'],
+            int(data['bitrate'].replace(' kbps', '')),
+            data['duration'], data['size']))
+    index = open_index(index_path)
+    try:
+        with index:
+            index.executemany('DELETE FROM videos WHERE path = ?',
+                              [(os.path.abspath(old),) for old in new_paths])
+            index.executemany(
+                f"INSERT OR REPLACE INTO videos ({', '.join(INDEX_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(INDEX_COLUMNS))})", rows)
+    finally:
+        index.close()
+    return len(rows)
+
+
+def parse_bitrate_kbps(value: str) -> int:
+    """Parse bitrate like '20M', '8000k' or '20Mbps' to kbps. A plain
+    number is kbps.
+
+    Args:
+        value (str): Bitrate
+
+    Returns:
+        int: Bitrate in kbps
+    """
+    value = value.strip().lower()
+    if value.endswith('bps'):
+        value = value[:-3]
+    if value.endswith('m'):
+        return int(float(value[:-1]) * 1000)
+    if value.endswith('k'):
+        return int(float(value[:-1]))
+    return int(float(value))
+
+
+def query_index(index_path: str, codecs: list = None, min_height: int = None,
+                max_height: int = None, min_bitrate: int = None,
+                max_bitrate: int = None, min_fps: float = None,
+                max_fps: float = None, path_like: str = None) -> list:
+    """Query the video index without probing any file.
+
+    Args:
+        index_path (str): Index path
+        codecs (list): Codec names, any of them matches
+        min_height (int): Min frame height
+        max_height (int): Max frame height
+        min_bitrate (int): Min bitrate, kbps
+        max_bitrate (int): Max bitrate, kbps
+        min_fps (float): Min frames per second
+        max_fps (float): Max frames per second
+        path_like (str): SQL LIKE pattern for the path
+
+    Returns:
+        list: Matching rows as dicts, ordered by path
+    """
+    conditions, params = [], []
+    if codecs:
+        conditions.append(f"codec IN ({', '.join('?' * len(codecs))})")
+        params.extend(codecs)
+    for column, op, value in (('height', '>=', min_height),
+                              ('height', '<=', max_height),
+                              ('bitrate', '>=', min_bitrate),
+                              ('bitrate', '<=', max_bitrate),
+                              ('fps', '>=', min_fps),
+                              ('fps', '<=', max_fps),
+                              ('path', 'LIKE', path_like)):
+        if value is not None:
+            conditions.append(f"{column} {op} ?")
+            params.append(value)
+    sql = f"SELECT {', '.join(INDEX_COLUMNS)} FROM videos"
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY path'
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"Index not found: '{index_path}'")
+    index = open_index(index_path)
+    try:
+        return [dict(zip(INDEX_COLUMNS, row)) 
+                for row in index.execute(sql, params)]
+    finally:
+        index.close()
+
+
+def query_main(argv):
+    global LOG_LEVEL
+    parser = argparse.ArgumentParser(
+        prog='video-label.py query',
+        description='Query a video index written with --index, e.g. all 4K ' \
+            + 'HEVC files over 20 Mbps: --codec hevc --min-height 2160 ' \
+            + '--min-bitrate 20M.')
+    parser.add_argument(
+        "index", type=str,
+        help="Index path.")
+    parser.add_argument(
+        "--codec", type=str, action='append', default=None,
+        help="Codec name, can be repeated.")
+    parser.add_argument(
+        "--min-height", type=int, default=None,
+        help="Min frame height, e.g. 2160 for 4K.")
+    parser.add_argument(
+        "--max-height", type=int, default=None,
+        help="Max frame height.")
+    parser.add_argument(
+        "--min-bitrate", type=parse_bitrate_kbps, default=None,
+        help="Min bitrate, e.g. '20M' or '8000k', plain number is kbps.")
+    parser.add_argument(
+        "--max-bitrate", type=parse_bitrate_kbps, default=None,
+        help="Max bitrate, same format as --min-bitrate.")
+    parser.add_argument(
+        "--min-fps", type=float, default=None,
+        help="Min frames per second.")
+    parser.add_argument(
+        "--max-fps", type=float, default=None,
+        help="Max frames per second.")
+    parser.add_argument(
+        "--path", type=str, default=None,
+        help="SQL LIKE pattern for the path, e.g. '%%/Movies/%%'.")
+    parser.add_argument(
+        "--csv", action='store_true',
+        help="Print CSV with a header row instead of one line per file.")
+    parser.add_argument(
+        "--log-level", type=str, default="INFO", choices=LOG_LEVELS.keys(),
+        help="Log level. Default: 'INFO'.")
+    args = parser.parse_args(argv)
+    LOG_LEVEL = LOG_LEVELS[args.log_level]
+
+    rows = query_index(args.index, args.codec, args.min_height,
+                       args.max_height, args.min_bitrate, args.max_bitrate,
+                       args.min_fps, args.max_fps, args.path)
+    if args.csv:
+        writer = csv.DictWriter(sys.stdout, fieldnames=INDEX_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+        return
+    for row in rows:
+        print(f"{row['path']}\t{row['resolution']}\t{row['fps']:g}fps\t" \
+            + f"{row['codec']}\t{row['bitrate']}Kbps\t" \
+            + f"{row['duration']:.1f}s\t{row['size']}")
+    Logger.info(f"{len(rows)} file(s)")
+
+# ==============================================================================
+# End of video index
+# ==============================================================================
+
+
+# ==============================================================================
+# Perceptual-hash duplicate detection
+# ==============================================================================
+# Frames per file, taken at keyframes evenly spread over the duration
+DUPES_FRAMES = 5
+# Frames are scaled to HASH_FRAME_SIZE x HASH_FRAME_SIZE gray for the DCT,
+# the top-left HASH_SIZE x HASH_SIZE coefficients make a 64-bit hash
+HASH_FRAME_SIZE = 32
+HASH_SIZE = 8
+# Max differing bits for two frame hashes to match
+DUPES_THRESHOLD = 10
+# Hashes are split into HASH_CHUNKS chunks for multi-index search
+HASH_CHUNKS = 4
+HASH_CHUNK_BITS = HASH_SIZE * HASH_SIZE // HASH_CHUNKS
+HASH_CHUNK_MASK = (1 << HASH_CHUNK_BITS) - 1
+# Frames with lower pixel variance (black, white, flat) hash unreliably
+FLAT_FRAME_VARIANCE = 16.0
+
+# Hashes from the NumPy and pure-Python DCT may differ in a few bits (float
+# sums in a different order), cached signatures are kept per backend
+HASH_BACKEND = 'python' if numpy is None else 'numpy'
+# DCT-II basis, only the rows for the kept coefficients
+DCT_ROWS = [[math.cos(math.pi * (2 * n + 1) * k / (2 * HASH_FRAME_SIZE))
+             for n in range(HASH_FRAME_SIZE)] for k in range(HASH_SIZE)]
+
+
+def get_keyframes_command(filepath: str, duration: float, frames: int) -> list:
+    """Get ffmpeg command that writes gray raw keyframes to stdout.
+    Each frame is its own input seeked with -noaccurate_seek, so ffmpeg
+    decodes one keyframe per position instead of the whole file.
+
+    Args:
+        filepath (str): Video file
+        duration (float): Video duration, seconds
+        frames (int): Number of frames
+
+    Returns:
+        list: ffmpeg command
+    """
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin']
+    filters = []
+    for i in range(frames):
+        position = duration * (i + 0.5) / frames
+        cmd += ['-noaccurate_seek', '-ss', f"{position:.3f}", '-i', filepath]
+        filters.append(
+            f"[{i}:v:0]trim=end_frame=1,setpts=PTS-STARTPTS,"
+            f"scale={HASH_FRAME_SIZE}:{HASH_FRAME_SIZE}:flags=area,"
+            f"setsar=1,format=gray[f{i}]")
+    filters.append(''.join(f"[f{i}]" for i in range(frames)) 
+                   + f"concat=n={frames}:v=1:a=0[out]")
+    cmd += ['-filter_complex', ';'.join(filters), '-map', '[out]',
+            '-f', 'rawvideo', '-pix_fmt', 'gray', '-']
+    return cmd
+
+
+def hash_frames(raw: bytes) -> list:
+    """Compute 64-bit DCT perceptual hashes of gray raw frames. Vectorized
+    with NumPy when available. The pure-Python fallback sums in a different
+    order, so coefficients close to the median can land on the other side
+    and the hashes may differ from NumPy's by a few bits.
+
+    Args:
+        raw (bytes): Concatenated HASH_FRAME_SIZE x HASH_FRAME_SIZE frames
+
+    Returns:
+        list: Hash per frame, None for flat frames
+    """
+    frame_bytes = HASH_FRAME_SIZE * HASH_FRAME_SIZE
+    count = len(raw) // frame_bytes
+    if count == 0:
+        return []
+    if numpy is not None:
+        pixels = numpy.frombuffer(raw[:count * frame_bytes], dtype=numpy.uint8)
+        pixels = pixels.reshape(count, HASH_FRAME_SIZE, HASH_FRAME_SIZE)
+        pixels = pixels.astype(numpy.float64)
+        basis = numpy.array(DCT_ROWS)
+        coefficients = (basis @ pixels @ basis.T).reshape(count, -1)
+        bits = coefficients > numpy.median(coefficients, axis=1, keepdims=True)
+        variances = pixels.reshape(count, -1).var(axis=1)
+        hashes = []
+        for frame_bits, variance in zip(bits, variances):
+            if variance < FLAT_FRAME_VARIANCE:
+                hashes.append(None)
+            else:
+                hashes.append(int.from_bytes(
+                    numpy.packbits(frame_bits).tobytes(), 'big'))
+        return hashes
+    hashes = []
+    for i in range(count):
+        frame = raw[i * frame_bytes:(i + 1) * frame_bytes]
+        mean = sum(frame) / frame_bytes
+        if sum((p - mean) ** 2 for p in frame) / frame_bytes < FLAT_FRAME_VARIANCE:
+            hashes.append(None)
+            continue
+        rows = [frame[y * HASH_FRAME_SIZE:(y + 1) * HASH_FRAME_SIZE]
+                for y in range(HASH_FRAME_SIZE)]
+        # basis @ frame, then (basis @ frame) @ basis.T
+        partial = [[sum(b * row[x] for b, row in zip(basis_row, rows))
+                    for x in range(HASH_FRAME_SIZE)] for basis_row in DCT_ROWS]
+        coefficients = [sum(p * b for p, b in zip(partial_row, basis_row))
+                        for partial_row in partial for basis_row in DCT_ROWS]
+        ordered = sorted(coefficients)
+        middle = len(ordered) // 2
+        median = (ordered[middle - 1] + ordered[middle]) / 2
+        value = 0
+        for c in coefficients:
+            value = (value << 1) | (c > median)
+        hashes.append(value)
+    return hashes
+
+
+class MultiIndexHash:
+    """Multi-index hashing over 64-bit hashes with Hamming distance. Each
+    hash is split into HASH_CHUNKS chunks with a table per chunk. Two
+    hashes within radius r have at least one chunk within r // HASH_CHUNKS
+    bits, so a search looks up only the chunk values that close instead
+    of comparing against every hash."""
+    def __init__(self):
+        self.tables = [{} for _ in range(HASH_CHUNKS)]
+        self.values = []
+        self.items = []
+
+    def add(self, value: int, item):
+        """Add hash with its item.
+
+        Args:
+            value (int): Hash
+            item: Anything returned by search
+        """
+        key = len(self.values)
+        self.values.append(value)
+        self.items.append(item)
+        for i, table in enumerate(self.tables):
+            chunk = (value >> (i * HASH_CHUNK_BITS)) & HASH_CHUNK_MASK
+            table.setdefault(chunk, []).append(key)
+
+    def search(self, value: int, radius: int) -> list:
+        """Find items whose hash is within radius.
+
+        Args:
+            value (int): Hash
+            radius (int): Max Hamming distance
+
+        Returns:
+            list: (item, distance) pairs
+        """
+        candidates = set()
+        flips = get_chunk_flips(radius // HASH_CHUNKS)
+        for i, table in enumerate(self.tables):
+            chunk = (value >> (i * HASH_CHUNK_BITS)) & HASH_CHUNK_MASK
+            # map/filter keep the per-flip lookups out of the Python loop
+            for keys in filter(None, map(table.get, map(chunk.__xor__, flips))):
+                candidates.update(keys)
+        values, items = self.values, self.items
+        # Hamming distance: set bits of the XOR
+        distances = [(key, bin(value ^ values[key]).count('1')) 
+                     for key in candidates]
+        return [(items[key], distance) for key, distance in distances
+                if distance <= radius]
+
+
+@functools.lru_cache(maxsize=None)
+def get_chunk_flips(bits: int) -> tuple:
+    """Get all chunk masks with at most bits set.
+
+    Args:
+        bits (int): Max set bits
+
+    Returns:
+        tuple: Masks, 0 first
+    """
+    return tuple(sum(1 << bit for bit in flipped)
+                 for count in range(bits + 1)
+                 for flipped in itertools.combinations(range(HASH_CHUNK_BITS), count))
+
+
+@Profiler.wrap
+async def get_signature_async(filepath: str, duration: float, frames: int,
+                              semaphore: asyncio.Semaphore) -> list:
+    """Extract keyframes with ffmpeg and hash them.
+
+    Args:
+        filepath (str): Video file
+        duration (float): Video duration, seconds
+        frames (int): Number of frames
+        semaphore (asyncio.Semaphore): Limits concurrent ffmpeg runs
+
+    Returns:
+        list: Frame hashes (None for flat frames), empty on error
+    """
+    try:
+        async with semaphore:
+            returncode, stdout, stderr = await run_command_async(
+                get_keyframes_command(filepath, duration, frames))
+    except OSError as e:
+        Logger.error(f"Error extracting frames: '{filepath}': {e}")
+        return []
+    if returncode != 0:
+        Logger.error(f"Error extracting frames: '{filepath}': " \
+            + stderr.decode(errors='replace').strip())
+        return []
+    return hash_frames(stdout)
+
+
+def load_signatures(index_path: str, frames: int) -> dict:
+    """Load cached signatures from the index. Only rows hashed by the 
+    current HASH_BACKEND are loaded, so hashes from different backends are 
+    never compared.
+
+    Args:
+        index_path (str): Index path
+        frames (int): Number of frames, other counts are ignored
+
+    Returns:
+        dict: Absolute path -> (size, mtime, hashes)
+    """
+    index = open_index(index_path)
+    try:
+        return {path: (size, mtime, json.loads(hashes))
+                for path, size, mtime, hashes in index.execute(
+                    'SELECT path, size, mtime, hashes FROM signatures '
+                    'WHERE frames = ? AND backend = ?', 
+                    (frames, HASH_BACKEND))}
+    finally:
+        index.close()
+
+
+def save_signatures(index_path: str, frames: int, signatures: dict):
+    """Cache signatures in the index, keyed by path, size and mtime, 
+    tagged with HASH_BACKEND.
+
+    Args:
+        index_path (str): Index path
+        frames (int): Number of frames
+        signatures (dict): File path -> frame hashes
+    """
+    rows = []
+    for filepath, hashes in signatures.items():
+        stat = os.stat(filepath)
+        rows.append((os.path.abspath(filepath), stat.st_size, stat.st_mtime,
+                     frames, json.dumps(hashes), HASH_BACKEND))
+    index = open_index(index_path)
+    try:
+        with index:
+            index.executemany(
+                'INSERT OR REPLACE INTO signatures '
+                '(path, size, mtime, frames, hashes, backend) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+    finally:
+        index.close()
+
+
+@Profiler.wrap
+async def get_signatures(files: list, frames: int, jobs: int,
+                         fast: bool = True, index_path: str = None) -> dict:
+    """Get frame hashes for files, reusing the index cache when the file
+    size and mtime did not change.
+
+    Args:
+        files (list): Video files
+        frames (int): Frames per file
+        jobs (int): Max concurrent probes and ffmpeg runs
+        fast (bool): Read MP4/MKV headers directly, ffprobe as fallback
+        index_path (str): SQLite index used as a cache, None for no cache
+
+    Returns:
+        dict: File path -> frame hashes
+    """
+    cached = load_signatures(index_path, frames) if index_path else {}
+    signatures, missing = {}, []
+    for filepath in files:
+        stat = os.stat(filepath)
+        entry = cached.get(os.path.abspath(filepath))
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            signatures[filepath] = entry[2]
+        else:
+            missing.append(filepath)
+    Logger.info(f"Signatures: {len(signatures)} cached, {len(missing)} to extract")
+
+    video_data = await probe_files(missing, jobs, fast)
+    semaphore = asyncio.Semaphore(jobs)
+    tasks = {}
+    for filepath in missing:
+        duration = video_data.get(filepath, {}).get('duration') or 0
+        if duration <= 0:
+            Logger.warning(f"Unknown duration, skipping: '{filepath}'")
+            continue
+        tasks[filepath] = asyncio.ensure_future(
+            get_signature_async(filepath, duration, frames, semaphore))
+    if tasks:
+        await asyncio.gather(*tasks.values())
+    extracted = {filepath: task.result() for filepath, task in tasks.items()
+                 if task.result()}
+    if index_path and extracted:
+        save_signatures(index_path, frames, extracted)
+    signatures.update(extracted)
+    return signatures
+
+
+@Profiler.wrap
+def find_duplicates(signatures: dict, threshold: int, min_matches: int) -> list:
+    """Group files whose frames at the same positions match. One
+    multi-index table per frame position, each file is looked up before it
+    is added, so every pair is compared once.
+
+    Args:
+        signatures (dict): File path -> frame hashes
+        threshold (int): Max differing bits for two frames to match
+        min_matches (int): Matching frames for two files to be duplicates
+
+    Returns:
+        list: Groups of duplicate file paths, largest first
+    """
+    tables = {}
+    parent = {filepath: filepath for filepath in signatures}
+
+    def find(filepath):
+        while parent[filepath] != filepath:
+            parent[filepath] = parent[parent[filepath]]
+            filepath = parent[filepath]
+        return filepath
+
+    for filepath, hashes in signatures.items():
+        matches = {}
+        for position, value in enumerate(hashes):
+            if value is None:
+                continue
+            table = tables.setdefault(position, MultiIndexHash())
+            for other, _ in table.search(value, threshold):
+                matches[other] = matches.get(other, 0) + 1
+            table.add(value, filepath)
+        for other, count in matches.items():
+            if count >= min_matches:
+                parent[find(filepath)] = find(other)
+
+    groups = {}
+    for filepath in signatures:
+        groups.setdefault(find(filepath), []).append(filepath)
+    return sorted((sorted(group) for group in groups.values() 
+                   if len(group) > 1), key=len, reverse=True)
+
+
+def dupes_main(argv):
+    global LOG_LEVEL
+    parser = argparse.ArgumentParser(
+        prog='video-label.py dupes',
+        description='Find near-duplicate videos by perceptual hashes of ' \
+            + 'keyframes, e.g. the same recording encoded differently.')
+    parser.add_argument(
+        "directory", type=str,
+        help="Directory with video files.")
+    parser.add_argument(
+        "-r", "--recursive", action='store_true',
+        help="Also look in subdirectories.")
+    parser.add_argument(
+        "--file-ext", type=str, default='.mp4',
+        help="File extension. Default: '.mp4'.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(),
+        help="Max concurrent ffmpeg runs. Default: number of CPUs.")
+    parser.add_argument(
+        "--frames", type=int, default=DUPES_FRAMES,
+        help=f"Keyframes hashed per file. Default: {DUPES_FRAMES}.")
+    parser.add_argument(
+        "--threshold", type=int, default=DUPES_THRESHOLD,
+        help="Max differing bits of 64 for two frames to match. " \
+            + f"Default: {DUPES_THRESHOLD}.")
+    parser.add_argument(
+        "--min-matches", type=int, default=None,
+        help="Matching frames for two files to be duplicates. " \
+            + "Default: more than half of --frames.")
+    parser.add_argument(
+        "--index", type=str, default=None,
+        help="SQLite index to cache frame hashes in, same as video-label.py " \
+            + "--index. Unchanged files are not decoded again.")
+    parser.add_argument(
+        "--probe", type=str, default='auto', choices=['auto', 'ffprobe'],
+        help="Duration source, same as video-label.py --probe. Default: 'auto'.")
+    parser.add_argument(
+        "--profile", type=str, default="",
+        help="Write a Chrome trace-event JSON of phases and " \
+            + "ffmpeg/ffprobe runs to this file. Default: off.")
+    parser.add_argument(
+        "--log-level", type=str, default="INFO", choices=LOG_LEVELS.keys(),
+        help="Log level. Default: 'INFO'.")
+    args = parser.parse_args(argv)
+    LOG_LEVEL = LOG_LEVELS[args.log_level]
+    if args.profile:
+        Profiler.enable(args.profile)
+
+    min_matches = args.min_matches or args.frames // 2 + 1
+    files = get_list_of_files(args.directory, args.file_ext, args.recursive)
+    if numpy is None:
+        Logger.info("NumPy not found, hashing frames in pure Python")
+    signatures = asyncio.run(get_signatures(
+        files, max(1, args.frames), max(1, args.jobs), 
+        args.probe == 'auto', args.index))
+    groups = find_duplicates(signatures, args.threshold, min_matches)
+    for group in groups:
+        print('\n'.join(group))
+        print()
+    Logger.info(f"{len(groups)} duplicate group(s) in {len(signatures)} file(s)")
+
+# ==============================================================================
+# End of perceptual-hash duplicate detection
+# ==============================================================================
+
+# Probes are mostly waiting on ffprobe or disk, so run many at once
+DEFAULT_JOBS = 64
+# Undo journals are written next to the relabeled files
+JOURNAL_PREFIX = '.video-label-undo-'
 
 def main():
+    global LOG_LEVEL, LOG_FILE
     parser = argparse.ArgumentParser(
-        description='Get and write video label to file. Make sure filename does not contain "[" and "]" characters.')
+        description='Get and write video label to file. Make sure filename does not contain "[" and "]" characters. ' \
+            + "Run 'video-label.py query -h' to query an index, " \
+            + "'video-label.py dupes -h' to find duplicates.")
 
     parser.add_argument(
         'filepath',
-        type=str,
+        type=str, nargs='?',
         help='File path'
     )
     parser.add_argument(
@@ -450,36 +1728,105 @@ def main():
         "--log-file", type=str, default=LOG_FILE,
         help="Log file. Default: './.logs/log.log'.")
     parser.add_argument(
-        "-j", "--jobs", type=int, default=os.cpu_count(),
+        "-j", "--jobs", type=int, default=DEFAULT_JOBS,
+        help=f"Max concurrent probes. Default: {DEFAULT_JOBS}."
     )
     parser.add_argument(
         "--file-ext", type=str, default='.mp4',
         help="File extension. Default: '.mp4'."
     )
+    parser.add_argument(
+        "--probe", type=str, default='auto', choices=['auto', 'ffprobe'],
+        help="'auto' reads MP4/MKV headers directly and uses ffprobe only " \
+            + "if that fails, 'ffprobe' always runs ffprobe. Default: 'auto'."
+    )
+    parser.add_argument(
+        "-r", "--recursive", action='store_true',
+        help="Also label files in subdirectories."
+    )
+    parser.add_argument(
+        "--index", type=str, default=None,
+        help="SQLite index to write path, resolution, fps, codec, bitrate, " \
+            + "duration and size to, also with --dry-run."
+    )
+    parser.add_argument(
+        "--dry-run", action='store_true',
+        help="Print planned renames without renaming anything."
+    )
+    parser.add_argument(
+        "--journal", type=str, default=None,
+        help="Undo journal path. Default: " \
+            + f"'{JOURNAL_PREFIX}<timestamp>.jsonl' next to the files."
+    )
+    parser.add_argument(
+        "--undo", type=str, metavar='JOURNAL', default=None,
+        help="Revert renames recorded in an undo journal and exit."
+    )
+    parser.add_argument(
+        "--profile", type=str, default="",
+        help="Write a Chrome trace-event JSON of phases and " \
+            + "ffmpeg/ffprobe runs to this file. Default: off.")
 
     args = parser.parse_args()
 
     LOG_LEVEL = LOG_LEVELS[args.log_level]
+    if args.profile:
+        Profiler.enable(args.profile)
+    # Logger creates the parent folder, so it must not be empty
+    LOG_FILE = os.path.abspath(args.log_file) if args.log_file else args.log_file
+
+    if args.undo:
+        reverted = undo_renames(args.undo)
+        Logger.happy(f"Reverted {reverted} file(s)")
+        return
+    if not args.filepath:
+        parser.error("filepath is required unless --undo is given")
 
     if os.path.isdir(args.filepath):
-        files = get_list_of_files(args.filepath, args.file_ext)
-        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
-            futures = [executor.submit(get_write_video_label, file) for file in files]
-            try:
-                concurrent.futures.wait(futures)
-            except KeyboardInterrupt:
-                Logger.info("Shutting down threads...")
-                stop_event.set()
-                for future in futures:
-                    future.cancel()
+        directory = args.filepath
+        files = get_list_of_files(args.filepath, args.file_ext, args.recursive)
+    else:
+        directory = os.path.dirname(args.filepath) or '.'
+        files = [args.filepath]
+
+    # Phase 1: probe everything, Ctrl-C here leaves the tree untouched
+    video_data = asyncio.run(probe_files(files, max(1, args.jobs), args.probe == 'auto'))
+    plan = plan_labels(video_data)
+    collisions = find_collisions(plan)
+    for old_path, new_path in collisions:
+        Logger.warning(f"Name collision, skipping: '{old_path}' -> '{new_path}'")
+    skipped = set(collisions)
+    plan = [rename for rename in plan if rename not in skipped]
+
+    if args.dry_run:
+        for old_path, new_path in plan:
+            print(f"'{old_path}' -> '{new_path}'")
+        Logger.info(f"Dry run: {len(plan)} file(s) to rename, " \
+            + f"{len(collisions)} collision(s)")
+        renamed = []
+    elif not plan:
+        Logger.info("Nothing to rename")
+        renamed = []
     else:
-        get_write_video_label(args.filepath)
+        # Phase 2: rename in one pass, journaled for --undo
+        journal = args.journal or get_journal_path(directory)
+        renamed = apply_renames(plan, journal)
+        Logger.happy(f"Renamed {len(renamed)} file(s), " \
+            + f"undo with: --undo '{journal}'")
+
+    if args.index:
+        indexed = update_index(args.index, video_data, renamed)
+        Logger.happy(f"Indexed {indexed} file(s) in '{args.index}'")
 
 
 if __name__ == '__main__':
-    signal.signal(signal.SIGINT, signal_handler)
     try:
-        main()
+        if sys.argv[1:2] == ['query']:
+            query_main(sys.argv[2:])
+        elif sys.argv[1:2] == ['dupes']:
+            dupes_main(sys.argv[2:])
+        else:
+            main()
     except Exception as e:
         Logger.error(f"Error: {e}")
     except KeyboardInterrupt: